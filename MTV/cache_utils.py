@@ -0,0 +1,394 @@
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+from PIL import Image
+
+
+def file_digest(path, chunk_size=1 << 20):
+
+    """
+    sha256 of a file's content. Used so that the cache is invalidated when a train file changes.
+    """
+
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def build_cache_key(model_helper, data_name, train_path, num_shot, num_example, seed, **extra):
+
+    """
+    Content address of the mean activations of one extraction setting.
+
+    Parameters:
+    model_helper: The model name, revision and attention hook names are read from it
+    data_name: Name of the dataset
+    train_path: The digest of this file is part of the key
+    num_shot, num_example, seed: The arguments of the extraction
+    extra: Anything else that changes the cached result, e.g. the settings of REINFORCE
+
+    Returns:
+    A hex string key
+    """
+
+    config = getattr(model_helper.model, "config", None)
+    fields = {"model": model_helper.model_config["name_or_path"],
+              "revision": getattr(config, "_commit_hash", None),
+              "dataset": data_name,
+              "train_digest": file_digest(train_path),
+              "num_shot": num_shot,
+              "num_example": num_example,
+              "seed": seed,
+              "hook_names": model_helper.model_config["attn_hook_names"]}
+    fields.update(extra)
+    return hashlib.sha256(json.dumps(fields, sort_keys=True, default=str).encode()).hexdigest()
+
+
+class ActivationCache:
+
+    """
+    On-disk cache of mean activations and REINFORCE outputs, addressed by build_cache_key.
+
+    Every key is a directory holding .npy files, which are loaded as memory maps. When the cache grows above max_bytes,
+    the least recently used keys are removed.
+    """
+
+    def __init__(self, cache_dir, max_bytes=None):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(cache_dir, exist_ok=True)
+
+
+    def _entry_path(self, key, name):
+        return os.path.join(self.cache_dir, key, f"{name}.npy")
+
+
+    def load(self, key, name):
+
+        """
+        Returns the cached tensor or None. The tensor is backed by a copy-on-write memory map of the file.
+        """
+
+        path = self._entry_path(key, name)
+        if not os.path.exists(path):
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        ###The directory time is what the eviction policy looks at
+        os.utime(os.path.join(self.cache_dir, key))
+        return torch.from_numpy(np.load(path, mmap_mode="c"))
+
+
+    def save(self, key, name, tensor, meta=None):
+
+        """
+        Writes the tensor atomically under key/name, then evicts old keys if the cache is over its size bound.
+        """
+
+        entry_dir = os.path.join(self.cache_dir, key)
+        os.makedirs(entry_dir, exist_ok=True)
+
+        array = tensor.detach().cpu()
+        if array.dtype == torch.bfloat16:
+            array = array.float()
+        path = self._entry_path(key, name)
+        tmp_path = path + ".tmp.npy"
+        np.save(tmp_path, array.numpy())
+        os.replace(tmp_path, path)
+
+        if meta is not None:
+            with open(os.path.join(entry_dir, "meta.json"), "w") as f:
+                json.dump(meta, f, default=str)
+
+        os.utime(entry_dir)
+        self.evict(keep=key)
+
+
+    def _entry_size(self, key):
+        entry_dir = os.path.join(self.cache_dir, key)
+        return sum(os.path.getsize(os.path.join(entry_dir, name)) for name in os.listdir(entry_dir))
+
+
+    def size(self):
+        return sum(self._entry_size(key) for key in os.listdir(self.cache_dir))
+
+
+    def evict(self, keep=None):
+
+        """
+        Removes least recently used keys until the cache fits in max_bytes. The key in keep is never removed.
+        """
+
+        if self.max_bytes is None:
+            return
+
+        entries = [(os.path.getmtime(os.path.join(self.cache_dir, key)), key) for key in os.listdir(self.cache_dir)]
+        total = sum(self._entry_size(key) for _, key in entries)
+        for _, key in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            total -= self._entry_size(key)
+            shutil.rmtree(os.path.join(self.cache_dir, key))
+
+
+    def report(self):
+        lookups = self.hits + self.misses
+        hit_rate = self.hits / lookups if lookups else 0.0
+        print(f"activation cache: {self.hits} hits, {self.misses} misses ({hit_rate:.0%}), {self.size() / 1e9:.2f}GB in {self.cache_dir}")
+
+
+class VisionFeatureCache:
+
+    """
+    LRU cache of the visual embeddings (after the projector) of every image, so the vision encoder only runs once per image.
+
+    Keys are built from the image path and its modification time, or from a content hash with key_mode="content".
+    At most max_items embeddings are kept on device. With spill_dir, evicted embeddings are written to disk and read back on the next miss.
+    """
+
+    def __init__(self, max_items=1024, device="cpu", spill_dir=None, key_mode="mtime"):
+        self.max_items = max_items
+        self.device = device
+        self.spill_dir = spill_dir
+        self.key_mode = key_mode
+        self.entries = OrderedDict()
+        self.lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+        if spill_dir is not None:
+            os.makedirs(spill_dir, exist_ok=True)
+
+
+    def image_key(self, image):
+
+        """
+        Key of an image given as a path. Tensors (already preprocessed images) are keyed by the hash of their content.
+        """
+
+        if torch.is_tensor(image):
+            return hashlib.sha1(image.detach().cpu().contiguous().view(torch.uint8).numpy().tobytes()).hexdigest()
+
+        if self.key_mode == "content" and os.path.isfile(image):
+            return file_digest(image)
+        if os.path.isfile(image):
+            return f"{os.path.abspath(image)}:{os.path.getmtime(image)}"
+        return image
+
+
+    def _spill_path(self, key):
+        return os.path.join(self.spill_dir, hashlib.sha1(key.encode()).hexdigest() + ".pt")
+
+
+    def get(self, key):
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            return self.entries[key]
+
+        if self.spill_dir is not None and os.path.exists(self._spill_path(key)):
+            features = torch.load(self._spill_path(key), map_location=self.device)
+            self.put(key, features)
+            return features
+        return None
+
+
+    def put(self, key, features):
+        self.entries[key] = features.detach().to(self.device)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_items:
+            old_key, old_features = self.entries.popitem(last=False)
+            if self.spill_dir is not None and not os.path.exists(self._spill_path(old_key)):
+                torch.save(old_features.cpu(), self._spill_path(old_key))
+
+
+    def encode(self, images, encode_fn, device=None):
+
+        """
+        Returns the stacked features of images, (n_images, ...). encode_fn is only called once, on the list of indices of the images that missed.
+
+        Parameters:
+        images: Image paths, or preprocessed image tensors
+        encode_fn: Takes a list of indices into images and returns their features stacked on the first dimension
+        device: Device of the returned features. Defaults to the device of encode_fn's output, or to the cache device.
+        """
+
+        keys = [self.image_key(image) for image in images]
+
+        ###Inputs can be prepared on prefetch threads
+        with self.lock:
+            features = [self.get(key) for key in keys]
+            missing = [i for i, cur_features in enumerate(features) if cur_features is None]
+            self.hits += len(keys) - len(missing)
+            self.misses += len(missing)
+
+            if missing:
+                ###The features are constants of the prompt, no autograd graph is kept over the encoder
+                with torch.no_grad():
+                    new_features = encode_fn(missing).detach()
+                device = new_features.device if device is None else device
+                for i, cur_features in zip(missing, new_features):
+                    self.put(keys[i], cur_features)
+                    features[i] = cur_features
+
+            return torch.stack([cur_features.to(device or self.device) for cur_features in features])
+
+
+    def report(self):
+        lookups = self.hits + self.misses
+        hit_rate = self.hits / lookups if lookups else 0.0
+        print(f"vision feature cache: {self.hits} hits, {self.misses} misses ({hit_rate:.0%}), {len(self.entries)} embeddings in memory")
+
+
+class ImageLoader:
+
+    """
+    Shared image loader. Decoded RGB images are kept in an LRU of max_items entries, and the images of a multi-image prompt are decoded
+    in parallel on a thread pool of num_workers threads. Hit rate and decode time are recorded for report().
+    """
+
+    def __init__(self, max_items=512, num_workers=4):
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.pool = None
+        self.hits = 0
+        self.misses = 0
+        self.decode_time = 0.0
+        self.configure(max_items, num_workers)
+
+
+    def configure(self, max_items=512, num_workers=4):
+        self.max_items = max_items
+        self.num_workers = num_workers
+        if self.pool is not None:
+            self.pool.shutdown()
+        self.pool = ThreadPoolExecutor(max_workers=num_workers) if num_workers > 1 else None
+        with self.lock:
+            while len(self.entries) > self.max_items:
+                self.entries.popitem(last=False)
+
+
+    def load(self, image_file):
+
+        """
+        Returns the decoded RGB image. Like models.load_image, the input is returned as it is when it can not be opened.
+        """
+
+        with self.lock:
+            if image_file in self.entries:
+                self.entries.move_to_end(image_file)
+                self.hits += 1
+                return self.entries[image_file]
+
+        start = time.perf_counter()
+        try:
+            image = Image.open(image_file).convert("RGB")
+        except:
+            return image_file
+        elapsed = time.perf_counter() - start
+
+        with self.lock:
+            self.misses += 1
+            self.decode_time += elapsed
+            if self.max_items > 0:
+                self.entries[image_file] = image
+                while len(self.entries) > self.max_items:
+                    self.entries.popitem(last=False)
+        return image
+
+
+    def load_many(self, image_files):
+        if self.pool is None or len(image_files) < 2:
+            return [self.load(image_file) for image_file in image_files]
+        return list(self.pool.map(self.load, image_files))
+
+
+    def report(self):
+        lookups = self.hits + self.misses
+        hit_rate = self.hits / lookups if lookups else 0.0
+        mean_decode = self.decode_time / self.misses if self.misses else 0.0
+        print(f"image cache: {self.hits} hits, {self.misses} decodes ({hit_rate:.0%} hit rate), {mean_decode * 1000:.1f}ms per decode, {self.decode_time:.1f}s decoding in total")
+
+
+class TokenCache:
+
+    """
+    Memoizes the tokenization of prompt fragments. Few-shot prompts are made of the same instructions, templates and dataset examples over
+    and over, so once they are split at boundaries the tokenizer never merges across (image tokens, special tokens), every fragment only
+    has to be tokenized once and a prompt is assembled by concatenating cached token ids.
+
+    Calling the cache with a plain text behaves like calling the tokenizer, so it can be passed to llava's tokenizer_image_token, which
+    tokenizes the chunks between <image> tokens separately. Other attributes are forwarded to the tokenizer.
+    """
+
+    def __init__(self, tokenizer, max_items=4096):
+        self.tokenizer = tokenizer
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.configure(max_items)
+
+
+    def configure(self, max_items=4096):
+        self.max_items = max_items
+        with self.lock:
+            while len(self.entries) > self.max_items:
+                self.entries.popitem(last=False)
+
+
+    def __getattr__(self, name):
+        return getattr(self.tokenizer, name)
+
+
+    def __call__(self, text, **kwargs):
+
+        ###Only the plain call is cached, anything with options goes to the tokenizer
+        if kwargs or not isinstance(text, str) or self.max_items <= 0:
+            return self.tokenizer(text, **kwargs)
+
+        with self.lock:
+            if text in self.entries:
+                self.entries.move_to_end(text)
+                self.hits += 1
+                return self.entries[text]
+
+        encoding = self.tokenizer(text)
+        with self.lock:
+            self.misses += 1
+            self.entries[text] = encoding
+            while len(self.entries) > self.max_items:
+                self.entries.popitem(last=False)
+        return encoding
+
+
+    def encode_fragments(self, fragments):
+
+        """
+        Token ids of the concatenation of fragments. Every fragment must start and end at a token boundary.
+        """
+
+        input_ids = []
+        for fragment in fragments:
+            if fragment:
+                input_ids.extend(self(fragment).input_ids)
+        return input_ids
+
+
+    def report(self):
+        lookups = self.hits + self.misses
+        hit_rate = self.hits / lookups if lookups else 0.0
+        print(f"token cache: {self.hits} hits, {self.misses} misses ({hit_rate:.0%}), {len(self.entries)} fragments")
@@ -1,27 +1,58 @@
 from mtv_utils import *
 from preprocess import *
+from cache_utils import ImageLoader, TokenCache
 from PIL import Image
+from transformers import StoppingCriteria
+import transformers
 import torch
 import copy
+import re
 
 # from llava.constants import IMAGE_TOKEN_INDEX, DEFAULT_IMAGE_TOKEN, DEFAULT_IM_START_TOKEN, DEFAULT_IM_END_TOKEN, IGNORE_INDEX
 # from llava.conversation import conv_templates, SeparatorStyle
 # from llava.mm_utils import process_images, tokenizer_image_token
 
+##Since transformers 4.39 a stopping criteria returns one flag per row, and finished rows stop while the others keep generating
+PER_ROW_STOPPING = tuple(int(v) for v in transformers.__version__.split(".")[:2]) >= (4, 39)
+
+
+class AnswerStoppingCriteria(StoppingCriteria):
+
+    """
+    Stops generation once the generated text of a row contains one of stop_strings, e.g. the "." or "\n" that ends a short VQA answer.
+
+    prompt_len: Number of prompt tokens at the start of the generated ids. 0 for models that only return the new tokens.
+    """
+
+    def __init__(self, tokenizer, stop_strings, prompt_len):
+        self.tokenizer = tokenizer
+        self.stop_strings = stop_strings
+        self.prompt_len = prompt_len
+        self.done = None
+
+
+    def __call__(self, input_ids, scores, **kwargs):
+        if self.done is None:
+            self.done = torch.zeros(input_ids.shape[0], dtype=torch.bool, device=input_ids.device)
+
+        new_text = self.tokenizer.batch_decode(input_ids[:, self.prompt_len:], skip_special_tokens=True)
+        self.done |= torch.tensor([any(stop in text for stop in self.stop_strings) for text in new_text], device=input_ids.device)
+
+        if PER_ROW_STOPPING:
+            return self.done.clone()
+        return bool(self.done.all())
+
+
+##Every helper decodes images through this loader. Use image_loader.configure to change the cache size and the number of decode threads.
+image_loader = ImageLoader()
+
+
 def load_image(image_file):
-    try:
-        image = Image.open(image_file).convert("RGB")
-    except:
-        return image_file
-    return image
+    return image_loader.load(image_file)
 
 
 def load_images(image_files):
-    out = []
-    for image_file in image_files:
-        image = load_image(image_file)
-        out.append(image)
-    return out
+    return image_loader.load_many(image_files)
 
 
 
@@ -37,8 +68,31 @@ class ModelHelper:
         self.cur_dataset: Name of the current dataset
         self.split_idx: The index of "layer" when you parse "attn_hook_names" with "."
         self.nonspecial_idx: The index in which the generated tokens are not special token. Used to skip special token and construct the current target output for loss calculation.
+        self.feature_cache: Optional VisionFeatureCache (refer to cache_utils.py) set with enable_feature_cache
+        self.token_cache: TokenCache (refer to cache_utils.py) that insert_image tokenizes the prompt fragments with, or None if the processor tokenizes
+        self.stop_strings: None, or the strings that end an answer when the lean generation profile is on. Refer to enable_lean_generation.
+        """
+
+
+    def enable_lean_generation(self, stop_strings):
+
+        """
+        Generation profile for short answers: generate stops on stop_strings (per row on newer transformers) and no longer keeps the hidden states of every step.
         """
 
+        self.stop_strings = stop_strings
+
+
+    def stopping_criteria(self, prompt_len):
+
+        """
+        Stopping criteria of the lean generation profile, as a list to extend the helper's own criteria with.
+        """
+
+        if self.stop_strings is None:
+            return []
+        return [AnswerStoppingCriteria(self.tokenizer, self.stop_strings, prompt_len)]
+
 
     #Always return a single variable. If both text and image is returned, return in tuple
     def insert_image(self, text, image_list):
@@ -47,6 +101,13 @@ class ModelHelper:
         Returns an object that is the input to forward and generate.
         """
         pass
+    #Same as insert_image, for a list of texts and a list of image lists
+    def insert_image_batch(self, texts, image_lists):
+
+        """
+        Returns a left padded batch in the same format as insert_image, so the last real token of every row is at position -1.
+        """
+        pass
     #Takes the output of insert_image
     def forward(self, model_input, labels=None):
 
@@ -62,6 +123,40 @@ class ModelHelper:
         Generate function wrapper
         """
         pass
+    #Takes the output of insert_image_batch
+    def generate_batch(self, model_input, max_new_tokens):
+
+        """
+        Same as generate for a left padded batch. Returns a list with the output text of every row.
+        """
+        pass
+    #Takes the output of insert image
+    def repeat_input(self, model_input, n):
+
+        """
+        Returns the same input repeated n times along the batch dimension.
+        """
+        pass
+    def enable_feature_cache(self, feature_cache):
+
+        """
+        Makes the model reuse the visual embeddings stored in feature_cache instead of running the vision encoder again for the same image.
+        """
+        pass
+    #Takes the output of insert image
+    def prefill(self, model_input, n_suffix=1):
+
+        """
+        Runs every token except the last n_suffix ones and returns the past_key_values of that prefix.
+        """
+        pass
+    #Takes the output of insert image and the past_key_values from prefill
+    def forward_suffix(self, model_input, past_key_values, n_suffix=1, labels=None):
+
+        """
+        Forward function wrapper that only runs the last n_suffix tokens on top of past_key_values.
+        """
+        pass
 
 
 class llavaOAHelper(ModelHelper):
@@ -82,6 +177,8 @@ class llavaOAHelper(ModelHelper):
         self.cur_dataset = cur_dataset
         self.split_idx = 2
         self.nonspecial_idx = 0
+        self.token_cache = TokenCache(tokenizer)
+        self.stop_strings = None
 
 
     def insert_image(self, text, image_list, gt=None):
@@ -95,7 +192,8 @@ class llavaOAHelper(ModelHelper):
         if gt is not None:
             prompt_question = prompt_question + gt
 
-        input_ids = tokenizer_image_token(prompt_question, self.tokenizer, IMAGE_TOKEN_INDEX, return_tensors="pt").unsqueeze(0).to("cuda")
+        ##tokenizer_image_token tokenizes the text between images chunk by chunk, so the chunks come from the token cache
+        input_ids = tokenizer_image_token(prompt_question, self.token_cache, IMAGE_TOKEN_INDEX, return_tensors="pt").unsqueeze(0).to("cuda")
 
         if image_list == []:
             return (input_ids, None, None)
@@ -118,6 +216,24 @@ class llavaOAHelper(ModelHelper):
         return result
     
 
+    def prefill(self, model_input, n_suffix=1):
+
+        result = self.model(model_input[0][:, :-n_suffix],
+            images=model_input[1],
+            image_sizes=model_input[2],
+            use_cache=True)
+        return result.past_key_values
+
+
+    def forward_suffix(self, model_input, past_key_values, n_suffix=1, labels=None):
+
+        result = self.model(model_input[0][:, -n_suffix:],
+            past_key_values=past_key_values,
+            labels=labels,
+            use_cache=True)
+        return result
+    
+
     def generate(self, model_input, max_new_tokens):
 
         cont = self.model.generate(
@@ -150,8 +266,15 @@ class QwenHelper(ModelHelper):
         self.split_idx = 2
         self.nonspecial_idx = 0
         self.question_lookup = None
+        self.feature_cache = None
+        self.stop_strings = None
+        self.token_cache = TokenCache(tokenizer)
 
-    def insert_image(self, text, image_list):
+        ##Qwen-VL opens the images itself inside visual.encode. Route it through the shared image loader.
+        self.visual_encode = model.transformer.visual.encode
+        model.transformer.visual.encode = self.encode_images
+
+    def build_prompt(self, text, image_list):
 
         text = text.replace("<image>", "<img></img>")
         text = text.split("</img>")
@@ -159,7 +282,26 @@ class QwenHelper(ModelHelper):
         new_text = ""
         for text_split, image in zip(text[:-1], image_list):
             new_text += f"{text_split}{image}</img>"
-        return self.tokenizer(new_text + text[-1], return_tensors='pt', padding='longest')
+        return new_text + text[-1]
+
+
+    ##<img> and </img> are special tokens, so the tokenizer never merges across them and the prompt can be tokenized in fragments:
+    ##the text between images and every <img>path</img> are tokenized once through the token cache and concatenated
+    def tokenize_prompt(self, prompt):
+
+        return self.token_cache.encode_fragments(re.split(r"(<img>.*?</img>)", prompt))
+
+
+    def insert_image(self, text, image_list):
+
+        return self.insert_image_batch([text], [image_list])
+
+
+    ##The tokenizer is set to pad on the left in load_model
+    def insert_image_batch(self, texts, image_lists):
+
+        input_ids = [self.tokenize_prompt(self.build_prompt(text, image_list)) for text, image_list in zip(texts, image_lists)]
+        return self.tokenizer.pad({"input_ids": input_ids}, return_tensors='pt', padding='longest')
     
 
     def forward(self, model_input, labels=None):
@@ -171,6 +313,11 @@ class QwenHelper(ModelHelper):
 
     def generate(self, model_input, max_new_tokens):
 
+        return self.generate_batch(model_input, max_new_tokens)[0]
+
+
+    def generate_batch(self, model_input, max_new_tokens):
+
         generated_output = self.model.generate(
                 input_ids=model_input["input_ids"].to(self.model.device),
                 attention_mask=model_input["attention_mask"].to(self.model.device),
@@ -180,13 +327,62 @@ class QwenHelper(ModelHelper):
                 min_new_tokens=1,
                 length_penalty=1,
                 num_return_sequences=1,
-                output_hidden_states=True,
+                output_hidden_states=self.stop_strings is None,
+                stopping_criteria=self.stopping_criteria(model_input["input_ids"].size(1)),
                 use_cache=True,
                 pad_token_id=self.tokenizer.eod_id,
                 eos_token_id=self.tokenizer.eod_id,)
         
-        return self.tokenizer.batch_decode(generated_output[:, model_input["input_ids"].size(1):],
-                            skip_special_tokens=True)[0].strip()
+        return [output.strip() for output in self.tokenizer.batch_decode(generated_output[:, model_input["input_ids"].size(1):],
+                            skip_special_tokens=True)]
+    
+
+    def repeat_input(self, model_input, n):
+
+        return {k: v.repeat(n, 1) for k, v in model_input.items()}
+
+
+    ##Same as Qwen-VL's visual.encode, with the images decoded by the shared image loader
+    def encode_images(self, image_paths):
+
+        visual = self.model.transformer.visual
+        opened_images = load_images(image_paths)
+
+        ##URLs and files that can not be opened are left to Qwen-VL's own loading
+        if any(isinstance(image, str) for image in opened_images):
+            return self.visual_encode(image_paths)
+        return visual(torch.stack([visual.image_transform(image) for image in opened_images], dim=0))
+
+
+    ##Qwen-VL reads the image paths back from the input ids and calls visual.encode on them, so the cache sits in front of encode
+    def enable_feature_cache(self, feature_cache):
+
+        self.feature_cache = feature_cache
+        visual = self.model.transformer.visual
+
+        def cached_encode(image_paths):
+            device = next(visual.parameters()).device
+            return feature_cache.encode(image_paths, lambda missing: self.encode_images([image_paths[i] for i in missing]), device=device)
+
+        visual.encode = cached_encode
+
+
+    ##The image tokens always sit in the prefix, so the suffix forward never goes through the vision encoder
+    def prefill(self, model_input, n_suffix=1):
+
+        result = self.model(input_ids=model_input["input_ids"][:, :-n_suffix].to(self.model.device),
+                attention_mask=model_input["attention_mask"][:, :-n_suffix].to(self.model.device),
+                use_cache=True)
+        return result.past_key_values
+
+
+    def forward_suffix(self, model_input, past_key_values, n_suffix=1, labels=None):
+
+        result = self.model(input_ids=model_input["input_ids"][:, -n_suffix:].to(self.model.device),
+                attention_mask=model_input["attention_mask"].to(self.model.device),
+                past_key_values=past_key_values,
+                use_cache=True)
+        return result
     
     
 class ViLAHelper(ModelHelper):
@@ -208,6 +404,9 @@ class ViLAHelper(ModelHelper):
         self.split_idx = 3
         self.nonspecial_idx = 0
         self.question_lookup = None
+        self.feature_cache = None
+        self.stop_strings = None
+        self.token_cache = TokenCache(tokenizer)
 
 
     ##No need to change the image token since it's the same as default
@@ -228,50 +427,113 @@ class ViLAHelper(ModelHelper):
         prompt = conv.get_prompt()
             
 
-        input_ids = tokenizer_image_token(prompt, self.tokenizer, IMAGE_TOKEN_INDEX, return_tensors="pt").unsqueeze(0).cuda()
+        input_ids = tokenizer_image_token(prompt, self.token_cache, IMAGE_TOKEN_INDEX, return_tensors="pt").unsqueeze(0).to(self.model.device)
         stop_str = conv.sep if conv.sep_style != SeparatorStyle.TWO else conv.sep2
         keywords = [stop_str]
         stopping_criteria = KeywordsStoppingCriteria(keywords, self.tokenizer, input_ids)
         return (input_ids, images_tensor, stopping_criteria, stop_str)
+
+
+    ##Batched inputs carry one image tensor per row and a left padded attention mask as a fifth element
+    def insert_image_batch(self, texts, image_lists):
+
+        rows = [self.insert_image(text, image_list) for text, image_list in zip(texts, image_lists)]
+        max_len = max(row[0].shape[1] for row in rows)
+        pad_token_id = self.tokenizer.pad_token_id if self.tokenizer.pad_token_id is not None else self.tokenizer.eos_token_id
+
+        input_ids = torch.full((len(rows), max_len), pad_token_id, dtype=rows[0][0].dtype, device=rows[0][0].device)
+        attention_mask = torch.zeros((len(rows), max_len), dtype=torch.long, device=rows[0][0].device)
+        for i, row in enumerate(rows):
+            cur_len = row[0].shape[1]
+            input_ids[i, max_len - cur_len:] = row[0][0]
+            attention_mask[i, max_len - cur_len:] = 1
+
+        return (input_ids, [row[1] for row in rows], rows[0][2], rows[0][3], attention_mask)
     
 
     def forward(self, model_input, labels=None): 
-    
-        result = self.model(model_input[0], images=[model_input[1]], labels=labels)
+
+        ##A list of image tensors comes from repeat_input or insert_image_batch, one entry per batch row
+        images = model_input[1] if isinstance(model_input[1], list) else [model_input[1]]
+        attention_mask = model_input[4] if len(model_input) > 4 else None
+        result = self.model(model_input[0], images=images, attention_mask=attention_mask, labels=labels)
         return result
     
 
     def generate(self, model_input, max_new_tokens):
 
+        return self.generate_batch(model_input, max_new_tokens)[0]
+
+
+    ##VILA generates from input embeddings and only returns the new tokens, so the answer stopping criteria start at 0
+    def generate_batch(self, model_input, max_new_tokens):
+
+        attention_mask = model_input[4] if len(model_input) > 4 else None
         if model_input[1] is None:
             output = self.model.generate(
                 model_input[0],
+                attention_mask=attention_mask,
                 max_new_tokens=max_new_tokens,
                 do_sample=False,
                 num_beams=1,
                 min_new_tokens=1,
                 use_cache=True,
-                stopping_criteria=[model_input[2]])    
+                stopping_criteria=[model_input[2]] + self.stopping_criteria(0))    
         else:
 
             output = self.model.generate(
                     model_input[0],
-                    images=[
-                        model_input[1],
-                    ],
+                    images=model_input[1] if isinstance(model_input[1], list) else [model_input[1]],
+                    attention_mask=attention_mask,
                     max_new_tokens=max_new_tokens,
                     do_sample=False,
                     num_beams=1,
                     min_new_tokens=1,
                     use_cache=True,
-                    stopping_criteria=[model_input[2]])
+                    stopping_criteria=[model_input[2]] + self.stopping_criteria(0))
     
-        output = self.tokenizer.batch_decode(output, skip_special_tokens=True)[0]
-        output = output.strip()
-        if output.endswith(model_input[3]):
-            output = output[: -len(model_input[3])]
-        output = output.strip()
-        return output 
+        outputs = []
+        for output in self.tokenizer.batch_decode(output, skip_special_tokens=True):
+            output = output.strip()
+            if output.endswith(model_input[3]):
+                output = output[: -len(model_input[3])]
+            outputs.append(output.strip())
+        return outputs
+    
+
+    ##encode_images only sees the preprocessed image tensors, so they are keyed by content
+    def enable_feature_cache(self, feature_cache):
+
+        self.feature_cache = feature_cache
+        encode_images = self.model.encode_images
+
+        def cached_encode_images(images):
+            return feature_cache.encode(list(images), lambda missing: encode_images(images[missing]), device=images.device)
+
+        self.model.encode_images = cached_encode_images
+
+
+    def repeat_input(self, model_input, n):
+
+        images = model_input[1] if isinstance(model_input[1], list) else [model_input[1]]
+        repeated = (model_input[0].repeat(n, 1), images * n, model_input[2], model_input[3])
+        if len(model_input) > 4:
+            repeated = repeated + (model_input[4].repeat(n, 1),)
+        return repeated
+
+
+    def prefill(self, model_input, n_suffix=1):
+
+        images = model_input[1] if isinstance(model_input[1], list) else [model_input[1]]
+        result = self.model(input_ids=model_input[0][:, :-n_suffix], images=images, use_cache=True)
+        return result.past_key_values
+
+
+    ##Without images the suffix goes straight to the language model
+    def forward_suffix(self, model_input, past_key_values, n_suffix=1, labels=None):
+
+        result = self.model(input_ids=model_input[0][:, -n_suffix:], images=None, past_key_values=past_key_values, labels=labels, use_cache=True)
+        return result
     
 
 class Idefics2Helper(ModelHelper):
@@ -293,16 +555,63 @@ class Idefics2Helper(ModelHelper):
         self.cur_dataset = cur_dataset
         self.split_idx = 3
         self.nonspecial_idx = 1
+        self.feature_cache = None
+        self.stop_strings = None
+        ##The processor expands every <image> into image tokens while it tokenizes, so the prompt is not tokenized in fragments
+        self.token_cache = None
 
 
     def insert_image(self, text, image_list):
 
+        if self.feature_cache is not None:
+            return self.insert_image_batch([text], [image_list])
+
         opened_images = load_images(image_list)
         inputs = self.processor(text=[text], images=[opened_images], padding=True, return_tensors="pt")
         inputs = {k: v.to(self.model.device) for k, v in inputs.items()}
         return inputs
 
 
+    ##The tokenizer is set to pad on the left in load_model. Rows with fewer images get all zero padding images, which the model skips.
+    def insert_image_batch(self, texts, image_lists):
+
+        ##The processor still expands every <image> into image tokens without images, and the model merges image_hidden_states in their place
+        if self.feature_cache is not None:
+            flat_images = [image for image_list in image_lists for image in image_list]
+            image_hidden_states = self.feature_cache.encode(flat_images, lambda missing: self.encode_images(load_images([flat_images[i] for i in missing])), device=self.model.device)
+            inputs = self.processor(text=texts, padding=True, return_tensors="pt")
+            inputs = {k: v.to(self.model.device) for k, v in inputs.items()}
+            inputs["image_hidden_states"] = image_hidden_states
+            return inputs
+
+        opened_images = [load_images(image_list) for image_list in image_lists]
+        inputs = self.processor(text=texts, images=opened_images, padding=True, return_tensors="pt")
+        inputs = {k: v.to(self.model.device) for k, v in inputs.items()}
+        return inputs
+
+
+    ##Same steps as Idefics2Model.forward: vision encoder, then the perceiver connector. Returns (n_images, image_seq_len, hidden)
+    ##No graph is needed over the vision encoder, even when called inside REINFORCE or on a prefetch thread with grad enabled
+    @torch.no_grad()
+    def encode_images(self, opened_images):
+
+        image_inputs = self.processor.image_processor(images=[opened_images], return_tensors="pt")
+        pixel_values = image_inputs["pixel_values"][0].to(self.model.device, self.model.dtype)
+        pixel_attention_mask = image_inputs["pixel_attention_mask"][0].to(self.model.device)
+
+        patch_size = self.model.config.vision_config.patch_size
+        patches_subgrid = pixel_attention_mask.unfold(1, patch_size, patch_size).unfold(2, patch_size, patch_size)
+        patch_attention_mask = (patches_subgrid.sum(dim=(-1, -2)) > 0).bool()
+
+        image_hidden_states = self.model.model.vision_model(pixel_values=pixel_values, patch_attention_mask=patch_attention_mask).last_hidden_state
+        return self.model.model.connector(image_hidden_states, attention_mask=patch_attention_mask.view(pixel_values.size(0), -1))
+
+
+    def enable_feature_cache(self, feature_cache):
+
+        self.feature_cache = feature_cache
+
+
     def forward(self, model_input, labels=None):
         result = self.model(**model_input)
         return result
@@ -310,6 +619,11 @@ class Idefics2Helper(ModelHelper):
 
     def generate(self, model_input, max_new_tokens):
 
+        return self.generate_batch(model_input, max_new_tokens)[0]
+
+
+    def generate_batch(self, model_input, max_new_tokens):
+
         output = self.model.generate(
                 **model_input,
                 max_new_tokens=max_new_tokens,
@@ -318,12 +632,36 @@ class Idefics2Helper(ModelHelper):
                 min_new_tokens=1,
                 length_penalty=1,
                 num_return_sequences=1,
-                output_hidden_states=True,
+                output_hidden_states=self.stop_strings is None,
+                stopping_criteria=self.stopping_criteria(model_input["input_ids"].size(1)),
                 use_cache=True,)
         
-        output = self.processor.batch_decode(output[:, model_input["input_ids"].size(1):],
-                            skip_special_tokens=True)[0].strip()
-        return output
+        return [cur_output.strip() for cur_output in self.processor.batch_decode(output[:, model_input["input_ids"].size(1):],
+                            skip_special_tokens=True)]
+    
+
+    def repeat_input(self, model_input, n):
+
+        return {k: v.repeat(n, *([1] * (v.dim() - 1))) for k, v in model_input.items()}
+    
+
+    def prefill(self, model_input, n_suffix=1):
+
+        prefix_input = dict(model_input)
+        prefix_input["input_ids"] = model_input["input_ids"][:, :-n_suffix]
+        prefix_input["attention_mask"] = model_input["attention_mask"][:, :-n_suffix]
+        result = self.model(**prefix_input, use_cache=True)
+        return result.past_key_values
+
+
+    def forward_suffix(self, model_input, past_key_values, n_suffix=1, labels=None):
+
+        result = self.model(input_ids=model_input["input_ids"][:, -n_suffix:],
+                attention_mask=model_input["attention_mask"],
+                past_key_values=past_key_values,
+                labels=labels,
+                use_cache=True)
+        return result
 
 
 
@@ -1,86 +1,286 @@
 from mtv_utils import *
 from models import *
 from preprocess import *
+from cache_utils import *
 from tqdm import tqdm
 import torch
 import argparse
+import os
 torch.set_grad_enabled(False)
 from transformers.utils import logging
 logging.set_verbosity_error() 
 
 
+def select_heads(args, model_helper, mean_activations, reinforce_data, eval_data, train_dataset, data_seed=None, settings_key=None):
+
+    """
+    Runs REINFORCE and picks the best of 10 head sets sampled from the trained bernoullis.
+    data_seed seeds the REINFORCE examples and, through the torch RNG, the sampled head masks. settings_key is stored in the checkpoints.
+
+    Returns: 
+    bernoullis: From reinforce
+    intervention_locations: From reinforce_intervention_location
+    """
+
+    if data_seed is not None:
+        torch.manual_seed(data_seed)
+
+    # ##Examples from the test set is used to visualize the validation loss
+    bernoullis = reinforce(mean_activations, model_helper, reinforce_data, eval_data, rollout_batch_size=args.rollout_batch_size, use_prefix_cache=args.use_prefix_cache,
+                           prefetch_depth=args.prefetch_depth, prefetch_workers=args.prefetch_workers, eval_batch_size=args.validation_batch_size, data_seed=data_seed,
+                           checkpoint_path=args.checkpoint_path, checkpoint_every=args.checkpoint_every, resume=args.resume,
+                           n_epochs=args.reinforce_epochs, lr=args.reinforce_lr, num_samples=args.reinforce_samples,
+                           patience=args.patience, prob_tol=args.prob_tol, entropy_threshold=args.entropy_threshold,
+                           estimator=args.estimator, antithetic=args.antithetic, adaptive_samples=args.adaptive_samples, min_samples=args.min_samples, noise_target=args.noise_target,
+                           distributed=args.distributed, settings_key=settings_key)
+    # torch.save(bernoullis, args.bernoullis_path)
+    # bernoullis = torch.load(args.bernoullis_path)
+
+    ##The other ranks only help with the rollouts
+    if dist_info()[0] != 0:
+        return bernoullis, None
+
+    best_heads = (999, None)
+    candidates = []
+    ###Sample multiple times and pick the best set of heads.
+    for _ in range(10):
+        ###Sample from the trained distribution and identify the intervention locations
+        sigmoid_tensor = torch.stack([torch.sigmoid(bernoulli).clamp(min=0, max=1) for bernoulli in bernoullis])
+        ###Thresholding heads with low probability from being sampled. Reduce the number of heads. Idefics2 empirically benefit from less heads.
+        if args.model_name == "idefics2":
+            sigmoid_tensor = torch.nn.functional.threshold(sigmoid_tensor, 0.8, 0)
+
+        
+        prob_dist = torch.distributions.Bernoulli(sigmoid_tensor)
+        candidates.append(prob_dist.sample())
+
+    ##One object for every candidate, so the batched validation prepares it only once
+    validation_data = train_dataset[:50]
+
+    ###Score all candidates on each prepared item at once, so the prompt is only run once per item with the prefix cache
+    if args.use_prefix_cache or args.rollout_batch_size is not None or args.validation_batch_size is not None:
+        candidate_losses = validate_reinforce(model_helper, bernoullis, 1e-3, mean_activations, validation_data, 0, sampled=torch.stack(candidates),
+                                              use_prefix_cache=args.use_prefix_cache, rollout_batch_size=args.rollout_batch_size, eval_batch_size=args.validation_batch_size)
+    else:
+        ##Candidates that are the same mask are only validated once
+        mask_losses = {}
+        for sampled in candidates:
+            if mask_key(sampled) not in mask_losses:
+                mask_losses[mask_key(sampled)] = validate_reinforce(model_helper, bernoullis, 1e-3, mean_activations, validation_data, 0, sampled=sampled)
+        print(f"validation: {len(mask_losses)} distinct masks out of {len(candidates)} candidates")
+        candidate_losses = [mask_losses[mask_key(sampled)] for sampled in candidates]
+
+    for sampled, cur_heads_loss in zip(candidates, candidate_losses):
+        intervention_locations = reinforce_intervention_location(sampled)
+        if cur_heads_loss < best_heads[0]:
+            best_heads = (cur_heads_loss, intervention_locations)
+
+    return bernoullis, best_heads[1]
+
+
 def eval_reinforce(args):
 
-    train_dataset = open_data(args.data_name, args.train_path)
-    val_dataset = open_data(args.data_name, args.val_path)
+    ##A resumed run must see the same examples and mean activations as the run that wrote the checkpoint
+    if args.resume and args.seed is None:
+        raise ValueError("--resume needs --seed, so that the resumed run samples the same data and extracts the same mean activations")
+
+    ##Data parallel REINFORCE, launched with torchrun. Every rank loads its own replica of the model, on its own GPU.
+    device_map = "auto"
+    if args.distributed:
+        if args.seed is None:
+            raise ValueError("--distributed needs --seed, so that every rank extracts the same mean activations")
+        ###gloo only moves the collectives to cpu, the rollouts themselves still run on cuda
+        if not torch.cuda.is_available():
+            raise ValueError("--distributed needs one GPU per rank, the extraction and the rollouts run on cuda")
+        torch.distributed.init_process_group(backend=args.dist_backend)
+        local_rank = int(os.environ.get("LOCAL_RANK", 0))
+        torch.cuda.set_device(local_rank)
+        device_map = {"": local_rank}
+    is_main = dist_info()[0] == 0
+
+    ##Seeds every random source so that runs, and with them the cache keys, are reproducible
+    if args.seed is not None:
+        random.seed(args.seed)
+        np.random.seed(args.seed)
+        torch.manual_seed(args.seed)
+
+    train_cache_path, val_cache_path = None, None
+    if args.data_cache_dir is not None:
+        os.makedirs(args.data_cache_dir, exist_ok=True)
+        train_cache_path = data_cache_path(args.data_cache_dir, args.train_path)
+        val_cache_path = data_cache_path(args.data_cache_dir, args.val_path)
+
+    train_dataset = open_data(args.data_name, args.train_path, parsed=args.parsed_data, cache_path=train_cache_path)
+    val_dataset = open_data(args.data_name, args.val_path, parsed=args.parsed_data, cache_path=val_cache_path)
 
 
     activation_data = train_dataset
     reinforce_data = random.sample(train_dataset, 100)
     eval_data = val_dataset[:50]
 
+    ##The seeds of every stage are drawn here, once, so a warm cache that skips a stage can not shift the seeds of the later ones
+    drawn_seed = random.getrandbits(32)
+    extraction_seed = args.data_seed if args.data_seed is not None else drawn_seed
+    reinforce_seed = random.getrandbits(32)
+    eval_seed = random.getrandbits(32)
+
+
+    image_loader.configure(max_items=args.image_cache_size, num_workers=args.image_workers)
 
     ##Load the model
-    model_helper = load_model(args.model_name, args.data_name)
+    model_helper = load_model(args.model_name, args.data_name, device_map=device_map)
+    if model_helper.token_cache is not None:
+        model_helper.token_cache.configure(max_items=args.token_cache_size)
+    if args.lean_generation:
+        model_helper.enable_lean_generation(get_answer_stop_strings(args.data_name))
+
+    feature_cache = None
+    if args.feature_cache_size is not None:
+        feature_cache = VisionFeatureCache(max_items=args.feature_cache_size, device=args.feature_cache_device, spill_dir=args.feature_cache_dir, key_mode=args.feature_cache_key)
+        model_helper.enable_feature_cache(feature_cache)
+
+    activation_cache = None
+    if args.cache_dir is not None:
+        max_bytes = None if args.cache_max_gb is None else int(args.cache_max_gb * 1e9)
+        activation_cache = ActivationCache(args.cache_dir, max_bytes=max_bytes)
 
     ##Mean activation of some in-context input
     if args.cur_mode != "clean":
 
-        mean_activations = get_last_mean_head_activations(activation_data, model_helper, N_TRIALS = args.num_example, shot=args.num_shot)
-
-        torch.save(mean_activations, args.activation_path)
-        mean_activations = torch.load(args.activation_path)
-
-        # ##Examples from the test set is used to visualize the validation loss
-        bernoullis = reinforce(mean_activations, model_helper, reinforce_data, eval_data)
-        # torch.save(bernoullis, args.bernoullis_path)
-        # bernoullis = torch.load(args.bernoullis_path)
-
-        best_heads = (999, None)
-        ###Sample multiple times and pick the best set of heads.
-        for _ in range(10):
-            ###Sample from the trained distribution and identify the intervention locations
-            sigmoid_tensor = torch.stack([torch.sigmoid(bernoulli).clamp(min=0, max=1) for bernoulli in bernoullis])
-            ###Thresholding heads with low probability from being sampled. Reduce the number of heads. Idefics2 empirically benefit from less heads.
-            if args.model_name == "idefics2":
-                sigmoid_tensor = torch.nn.functional.threshold(sigmoid_tensor, 0.8, 0)
-
-            
-            prob_dist = torch.distributions.Bernoulli(sigmoid_tensor)
-            sampled = prob_dist.sample()
-            intervention_locations = reinforce_intervention_location(sampled)
-            cur_heads_loss = validate_reinforce(model_helper, bernoullis, 1e-3, mean_activations, train_dataset[:50], 0, sampled=sampled)
-            if cur_heads_loss < best_heads[0]:
-                best_heads = (cur_heads_loss, intervention_locations)
-        torch.save(best_heads[1], args.bernoullis_path)
-        intervention_locations = best_heads[1]
-
-        intervention_locations = torch.load(args.bernoullis_path)
-        print(len(intervention_locations))
+        mean_activations = None
+        ##Reduced from the shards of mtv_extract.py
+        if args.mean_activations_path is not None:
+            mean_activations = torch.load(args.mean_activations_path)
+        elif activation_cache is not None:
+            ##Keys of runs without --data_seed stay as they were
+            trial_seed = {} if args.data_seed is None else {"data_seed": args.data_seed}
+            activation_key = build_cache_key(model_helper, args.data_name, args.train_path, args.num_shot, args.num_example, args.seed, **trial_seed)
+            mean_activations = activation_cache.load(activation_key, "mean_activations")
+
+        if mean_activations is None:
+            mean_activations = get_last_mean_head_activations(activation_data, model_helper, N_TRIALS = args.num_example, shot=args.num_shot, batch_size=args.extraction_batch_size,
+                                                              prefetch_depth=args.prefetch_depth, prefetch_workers=args.prefetch_workers, data_seed=extraction_seed)
+            if activation_cache is not None and is_main:
+                activation_cache.save(activation_key, "mean_activations", mean_activations, meta=vars(args))
+        else:
+            mean_activations = mean_activations.to("cuda")
+
+        if args.activation_path is not None:
+            torch.save(mean_activations, args.activation_path)
+            mean_activations = torch.load(args.activation_path)
+
+        ##One copy of the task vector per layer, on that layer's device, shared by head selection and the evaluation
+        mean_activations = place_activations(mean_activations, model_helper.model, model_helper.model_config, split_idx=model_helper.split_idx)
+
+        ##Everything that changes the REINFORCE result. Keys the cached heads, and a checkpoint only resumes a run with the same key.
+        ##Heads selected on reduced activations are not shared with the ones of this extraction setting
+        key_extra = {} if args.mean_activations_path is None else {"mean_activations": file_digest(args.mean_activations_path)}
+        if args.data_seed is not None:
+            key_extra["data_seed"] = args.data_seed
+        key_extra["reinforce_seed"] = reinforce_seed
+        ###With patience the validation loss on val_path decides when REINFORCE stops
+        if args.patience is not None:
+            key_extra["val_digest"] = file_digest(args.val_path)
+        reinforce_key = build_cache_key(model_helper, args.data_name, args.train_path, args.num_shot, args.num_example, args.seed,
+                                        stage="reinforce", model_name=args.model_name, epochs=args.reinforce_epochs, lr=args.reinforce_lr,
+                                        num_samples=args.reinforce_samples, patience=args.patience, prob_tol=args.prob_tol, entropy_threshold=args.entropy_threshold,
+                                        estimator=args.estimator, antithetic=args.antithetic, adaptive_samples=args.adaptive_samples, min_samples=args.min_samples, noise_target=args.noise_target,
+                                        **key_extra)
+
+        best_mask = None
+        if activation_cache is not None:
+            best_mask = activation_cache.load(reinforce_key, "best_heads")
+
+        if best_mask is not None:
+            intervention_locations = reinforce_intervention_location(best_mask)
+        else:
+            bernoullis, intervention_locations = select_heads(args, model_helper, mean_activations, reinforce_data, eval_data, train_dataset, data_seed=reinforce_seed,
+                                                              settings_key=reinforce_key)
+            if activation_cache is not None and is_main:
+                activation_cache.save(reinforce_key, "bernoullis", torch.stack(bernoullis))
+                activation_cache.save(reinforce_key, "best_heads",
+                                      intervention_locations_to_mask(intervention_locations, model_helper.model_config["n_layers"], model_helper.model_config["n_heads"]))
+
+        ###Head selection is done, the evaluation runs on rank 0 only
+        if args.distributed:
+            torch.distributed.barrier()
+            if not is_main:
+                torch.distributed.destroy_process_group()
+                return
+
+        if args.bernoullis_path is not None:
+            torch.save(intervention_locations, args.bernoullis_path)
+            intervention_locations = compile_intervention_locations(torch.load(args.bernoullis_path))
+        print(sum(len(heads) for heads in intervention_locations.values()))
     else:
         mean_activations = None
         intervention_locations = None
 
+    if activation_cache is not None:
+        activation_cache.report()
+
     clean_answers = []
     interv_answers = []
     clean_count, interv_count = 0, 0
 
-    for item in tqdm(val_dataset):
+    ##Item i is always formatted with item_rng(eval_seed, i), so the prompts do not depend on the batch size
+    eval_batch_size = args.eval_batch_size
+    def prepare_eval_batch(batch_index):
+        indices = range(batch_index * eval_batch_size, min((batch_index + 1) * eval_batch_size, len(val_dataset)))
+        formatted = [model_helper.format_func(train_dataset, val_dataset[index], num_shot=args.eval_num_shot, rng=item_rng(eval_seed, index)) for index in indices]
+        if eval_batch_size == 1:
+            new_input = model_helper.insert_image(formatted[0][0], formatted[0][1])
+        else:
+            new_input = model_helper.insert_image_batch([item[0] for item in formatted], [item[1] for item in formatted])
+        return new_input, [item[2] for item in formatted], [item[3] for item in formatted]
 
-        text, image_list, target_out, question_id = model_helper.format_func(train_dataset, item, num_shot=args.eval_num_shot)
-        new_input = model_helper.insert_image(text, image_list)
-        clean_out, interv_out = fv_intervention_natural_text(new_input, model_helper, max_new_tokens=args.max_token, return_item=args.cur_mode, intervention_locations=intervention_locations, avg_activations=mean_activations)
+    ##The score mode reads the option logits of one forward pass instead of generating
+    options = get_answer_options(args.data_name)
+    if args.eval_mode == "score":
+        if options is None:
+            raise ValueError(f"{args.data_name} has no closed answer set, use --eval_mode generate")
+        option_ids = option_token_ids(model_helper, options)
+    clean_margins, interv_margins = [], []
 
+    n_batches = (len(val_dataset) + eval_batch_size - 1) // eval_batch_size
+    for new_input, target_outs, question_ids in tqdm(Prefetcher(prepare_eval_batch, n_batches, depth=args.prefetch_depth, num_workers=args.prefetch_workers)):
 
-        if args.model_name == "Qwen-VL":
-            interv_answers.append({"answer":interv_out, "question_id":question_id})
-            clean_answers.append({"answer":clean_out, "question_id":question_id})
+        if args.eval_mode == "score":
+            clean_scores, interv_scores = score_options(new_input, model_helper, option_ids, return_item=args.cur_mode, intervention_locations=intervention_locations, avg_activations=mean_activations,
+                                                        batched_input=eval_batch_size > 1, paired=args.paired_generation)
+            outs = []
+            for scores, margins in ((clean_scores, clean_margins), (interv_scores, interv_margins)):
+                if scores is None:
+                    outs.append(["None"] * len(target_outs))
+                    continue
+                ##Margin between the most and the second most probable option
+                top_scores = scores.topk(2, dim=-1).values
+                margins.extend((top_scores[:, 0] - top_scores[:, 1]).tolist())
+                outs.append([options[option] for option in scores.argmax(dim=-1).tolist()])
+            clean_outs, interv_outs = outs
         else:
-            interv_answers.append({"answer":interv_out.split(".")[0].split("\n")[0].strip(), "question_id":question_id})
-            clean_answers.append({"answer":clean_out.split(".")[0].split("\n")[0].strip(), "question_id":question_id})
+            clean_outs, interv_outs = fv_intervention_natural_text(new_input, model_helper, max_new_tokens=args.max_token, return_item=args.cur_mode, intervention_locations=intervention_locations, avg_activations=mean_activations,
+                                                                   batched_input=eval_batch_size > 1, paired=args.paired_generation)
+            if eval_batch_size == 1:
+                clean_outs, interv_outs = [clean_outs], [interv_outs]
+
+        for clean_out, interv_out, target_out, question_id in zip(clean_outs, interv_outs, target_outs, question_ids):
+
+            if args.model_name == "Qwen-VL":
+                interv_answers.append({"answer":interv_out, "question_id":question_id})
+                clean_answers.append({"answer":clean_out, "question_id":question_id})
+            else:
+                interv_answers.append({"answer":interv_out.split(".")[0].split("\n")[0].strip(), "question_id":question_id})
+                clean_answers.append({"answer":clean_out.split(".")[0].split("\n")[0].strip(), "question_id":question_id})
+
+            clean_count += int(clean_out.split(".")[0].split("\n")[0].strip().lower() == target_out.lower())
+            interv_count += int(interv_out.split(".")[0].split("\n")[0].strip().lower() == target_out.lower())
 
-        clean_count += int(clean_out.split(".")[0].split("\n")[0].strip().lower() == target_out.lower())
-        interv_count += int(interv_out.split(".")[0].split("\n")[0].strip().lower() == target_out.lower())
+    image_loader.report()
+    if feature_cache is not None:
+        feature_cache.report()
+    if model_helper.token_cache is not None:
+        model_helper.token_cache.report()
 
     if args.is_eval:
 
@@ -88,6 +288,8 @@ def eval_reinforce(args):
 
             if args.data_name == "flower" or args.data_name =="cub" or args.data_name == "dtd":
                 print(f"Intervention Score:{interv_count/len(val_dataset)}")
+                if interv_margins:
+                    print(f"Intervention option margin:{np.mean(interv_margins)}")
             else:
                 print(f"{args.data_name}_{args.experiment_name} Intervention Score:")
                 eval_vqa(f"{args.data_name}_val", args.result_folder + f"{args.experiment_name}_interv.json", interv_answers)
@@ -95,6 +297,8 @@ def eval_reinforce(args):
         if args.cur_mode == "clean" or args.cur_mode == "both":
             if args.data_name == "flower" or args.data_name =="cub" or args.data_name == "dtd":
                 print(f"Clean Score:{clean_count/len(val_dataset)}")
+                if clean_margins:
+                    print(f"Clean option margin:{np.mean(clean_margins)}")
             else:
                 print(f"{args.data_name}_{args.experiment_name} Clean Score:")
                 eval_vqa(f"{args.data_name}_val", args.result_folder + f"{args.experiment_name}_clean.json", clean_answers)
@@ -116,6 +320,46 @@ if __name__ == "__main__":
     parser.add_argument("--cur_mode", type=str, default="interv")
     parser.add_argument("--experiment_name", type=str, default="")
     parser.add_argument("--activation_path", type=str, default=None)
+    parser.add_argument("--mean_activations_path", type=str, default=None, help="Mean activations from mtv_extract.py reduce, skips the extraction")
+    parser.add_argument("--rollout_batch_size", type=int, default=None)
+    parser.add_argument("--use_prefix_cache", action="store_true")
+    parser.add_argument("--extraction_batch_size", type=int, default=1)
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--data_seed", type=int, default=None, help="Seed of the extraction trials, the same as mtv_extract.py worker --data_seed")
+    parser.add_argument("--cache_dir", type=str, default=None)
+    parser.add_argument("--cache_max_gb", type=float, default=None)
+    parser.add_argument("--feature_cache_size", type=int, default=None)
+    parser.add_argument("--feature_cache_device", type=str, default="cpu")
+    parser.add_argument("--feature_cache_dir", type=str, default=None)
+    parser.add_argument("--feature_cache_key", type=str, default="mtime", choices=["mtime", "content"])
+    parser.add_argument("--image_cache_size", type=int, default=512)
+    parser.add_argument("--image_workers", type=int, default=4)
+    parser.add_argument("--prefetch_depth", type=int, default=0)
+    parser.add_argument("--prefetch_workers", type=int, default=1)
+    parser.add_argument("--parsed_data", action="store_true")
+    parser.add_argument("--data_cache_dir", type=str, default=None)
+    parser.add_argument("--token_cache_size", type=int, default=4096)
+    parser.add_argument("--validation_batch_size", type=int, default=None)
+    parser.add_argument("--eval_batch_size", type=int, default=1)
+    parser.add_argument("--paired_generation", action="store_true")
+    parser.add_argument("--eval_mode", type=str, default="generate", choices=["generate", "score"])
+    parser.add_argument("--lean_generation", action="store_true")
+    parser.add_argument("--checkpoint_path", type=str, default=None)
+    parser.add_argument("--checkpoint_every", type=int, default=50)
+    parser.add_argument("--resume", action="store_true")
+    parser.add_argument("--reinforce_epochs", type=int, default=600)
+    parser.add_argument("--reinforce_lr", type=float, default=0.1)
+    parser.add_argument("--reinforce_samples", type=int, default=32)
+    parser.add_argument("--patience", type=int, default=None)
+    parser.add_argument("--prob_tol", type=float, default=None)
+    parser.add_argument("--entropy_threshold", type=float, default=None)
+    parser.add_argument("--estimator", type=str, default="normalized", choices=["normalized", "leave_one_out", "moving_average"])
+    parser.add_argument("--antithetic", action="store_true")
+    parser.add_argument("--adaptive_samples", action="store_true")
+    parser.add_argument("--min_samples", type=int, default=8)
+    parser.add_argument("--noise_target", type=float, default=1.0)
+    parser.add_argument("--distributed", action="store_true", help="Data parallel REINFORCE, launch with torchrun --nproc_per_node")
+    parser.add_argument("--dist_backend", type=str, default="nccl", choices=["nccl", "gloo"], help="gloo reduces the rollout losses on cpu, the model still runs on cuda")
     
     args = parser.parse_args()
 
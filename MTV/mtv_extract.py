@@ -0,0 +1,100 @@
+from mtv_utils import *
+from models import *
+from preprocess import *
+from cache_utils import *
+import torch
+import argparse
+import glob
+import os
+torch.set_grad_enabled(False)
+from transformers.utils import logging
+logging.set_verbosity_error()
+
+
+def extract_worker(args):
+
+    """
+    Extracts the activation statistics of one shard of the trials. Workers need no coordination: shard s runs trials s, s + num_shards, ...,
+    and every trial is sampled from (data_seed, trial) alone, so any number of workers can run on separate processes or nodes.
+    """
+
+    if args.seed is not None:
+        random.seed(args.seed)
+        np.random.seed(args.seed)
+        torch.manual_seed(args.seed)
+    data_seed = args.data_seed if args.data_seed is not None else args.seed
+    if data_seed is None:
+        raise ValueError("the workers need --data_seed (or --seed) to sample consistent trials")
+
+    trials = shard_trials(args.num_example, args.shard, args.num_shards)
+
+    train_cache_path = None
+    if args.data_cache_dir is not None:
+        os.makedirs(args.data_cache_dir, exist_ok=True)
+        train_cache_path = data_cache_path(args.data_cache_dir, args.train_path)
+    train_dataset = open_data(args.data_name, args.train_path, parsed=args.parsed_data, cache_path=train_cache_path)
+
+    image_loader.configure(max_items=args.image_cache_size, num_workers=args.image_workers)
+    model_helper = load_model(args.model_name, args.data_name)
+
+    activation_stats = get_last_mean_head_activations(train_dataset, model_helper, N_TRIALS=args.num_example, shot=args.num_shot, batch_size=args.extraction_batch_size,
+                                                      prefetch_depth=args.prefetch_depth, prefetch_workers=args.prefetch_workers, data_seed=data_seed,
+                                                      trials=trials, return_stats=True)
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    shard_path = os.path.join(args.output_dir, f"shard_{args.shard:05d}_of_{args.num_shards:05d}.npz")
+    ###Shards of another model, dataset, train file or shot count have a different key and are refused by the reducer
+    extraction_key = build_cache_key(model_helper, args.data_name, args.train_path, args.num_shot, args.num_example, data_seed, stage="shards")
+    save_activation_sums(shard_path, activation_stats, args.shard, args.num_shards, args.num_example, data_seed, extraction_key=extraction_key)
+    print(f"shard {args.shard} of {args.num_shards}: {activation_stats.count} trials written to {shard_path}")
+
+
+def reduce_shards(args):
+
+    """
+    Merges the shard files of extract_worker into the mean activations, saved with torch.save for mtv_eval.py --mean_activations_path.
+    """
+
+    paths = sorted(glob.glob(os.path.join(args.output_dir, "shard_*.npz")))
+    mean_activations, var_activations, count = reduce_activation_sums(paths)
+
+    torch.save(mean_activations, args.mean_activations_path)
+    if args.var_activations_path is not None:
+        torch.save(var_activations, args.var_activations_path)
+    print(f"{len(paths)} shards, {count} trials reduced into {args.mean_activations_path}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Map-reduce extraction of the mean activations. Run one worker per shard, then reduce.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    worker_parser = subparsers.add_parser("worker")
+    worker_parser.add_argument("--model_name", type=str, default="Qwen")
+    worker_parser.add_argument("--data_name", type=str, default="vizwiz")
+    worker_parser.add_argument("--train_path", type=str, default=None)
+    worker_parser.add_argument("--num_example", type=int, default=100)
+    worker_parser.add_argument("--num_shot", type=int, default=4)
+    worker_parser.add_argument("--shard", type=int, default=0)
+    worker_parser.add_argument("--num_shards", type=int, default=1)
+    worker_parser.add_argument("--seed", type=int, default=None)
+    worker_parser.add_argument("--data_seed", type=int, default=None, help="Seed of the trials, must be the same on every worker. Defaults to --seed")
+    worker_parser.add_argument("--output_dir", type=str, required=True)
+    worker_parser.add_argument("--extraction_batch_size", type=int, default=1)
+    worker_parser.add_argument("--prefetch_depth", type=int, default=0)
+    worker_parser.add_argument("--prefetch_workers", type=int, default=1)
+    worker_parser.add_argument("--image_cache_size", type=int, default=512)
+    worker_parser.add_argument("--image_workers", type=int, default=4)
+    worker_parser.add_argument("--parsed_data", action="store_true")
+    worker_parser.add_argument("--data_cache_dir", type=str, default=None)
+
+    reduce_parser = subparsers.add_parser("reduce")
+    reduce_parser.add_argument("--output_dir", type=str, required=True)
+    reduce_parser.add_argument("--mean_activations_path", type=str, required=True)
+    reduce_parser.add_argument("--var_activations_path", type=str, default=None)
+
+    args = parser.parse_args()
+
+    if args.command == "worker":
+        extract_worker(args)
+    else:
+        reduce_shards(args)
@@ -3,10 +3,13 @@ from baukit import TraceDict, get_module
 from models import *
 from preprocess import *
 import sys
+import os
 import torch
 import numpy as np
 import json
 import random
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 from tqdm import tqdm
 
 from transformers import AutoModelForCausalLM, AutoTokenizer, AutoProcessor, AutoModelForVision2Seq, logging
@@ -23,7 +26,7 @@ from vqa import VQA
 from vqa_eval import VQAEval
 
 
-def load_model(model_name, cur_dataset):
+def load_model(model_name, cur_dataset, device_map="auto"):
 
     """
     A function that loads the model and a corresponding model_helper. Refer to model.py for more detail.
@@ -31,6 +34,7 @@ def load_model(model_name, cur_dataset):
     Parameters:
     model_name: The name of the model you are attempting to load
     cur_dataset: The name of dataset you are attempting to load
+    device_map: Passed to from_pretrained. Data parallel runs give every rank its own replica with {"": local_rank}.
 
     Returns: 
     model_helper: A helper class that contains the model as well as other functionality.
@@ -38,7 +42,7 @@ def load_model(model_name, cur_dataset):
 
     if model_name == "Qwen-VL":
         
-        model = AutoModelForCausalLM.from_pretrained("Qwen/Qwen-VL", device_map="auto", trust_remote_code=True, fp16=True).eval()
+        model = AutoModelForCausalLM.from_pretrained("Qwen/Qwen-VL", device_map=device_map, trust_remote_code=True, fp16=True).eval()
 
         tokenizer = AutoTokenizer.from_pretrained("Qwen/Qwen-VL", trust_remote_code=True)
         tokenizer.padding_side = 'left'
@@ -55,18 +59,21 @@ def load_model(model_name, cur_dataset):
 
         disable_torch_init()
         model_name = get_model_name_from_path("Efficient-Large-Model/Llama-3-VILA1.5-8b")
-        tokenizer, model, image_processor, context_len = load_pretrained_model("Efficient-Large-Model/Llama-3-VILA1.5-8b", model_name, None)
+        tokenizer, model, image_processor, context_len = load_pretrained_model("Efficient-Large-Model/Llama-3-VILA1.5-8b", model_name, None, device_map=device_map)
+        ###Keeps the last real token of batched inputs at position -1 after the image tokens are expanded
+        model.config.tokenizer_padding_side = 'left'
         model_helper = ViLAHelper(model, tokenizer, image_processor, cur_dataset)
 
     if model_name == "idefics2":
         
         processor = AutoProcessor.from_pretrained("HuggingFaceM4/idefics2-8b")
         processor.image_processor.do_image_splitting = False
+        processor.tokenizer.padding_side = 'left'
         model = AutoModelForVision2Seq.from_pretrained(
             "HuggingFaceM4/idefics2-8b",
             torch_dtype=torch.float16,
             _attn_implementation="flash_attention_2",
-            device_map="auto"
+            device_map=device_map
         )
 
         model_helper = Idefics2Helper(model, processor, cur_dataset)
@@ -74,8 +81,62 @@ def load_model(model_name, cur_dataset):
     return model_helper
 
 
+def item_rng(seed, index):
+
+    """
+    The random.Random used to prepare item index. It only depends on the seed and the index, never on the order the items are prepared in.
+    """
+
+    return random.Random(f"{seed}:{index}")
+
+
+class Prefetcher:
+
+    """
+    Prepares the inputs of the next iterations on a thread pool while the current one runs on the GPU.
+
+    make_item(index) is called for every index in range(start, n_items) and the results are yielded in order.
+    At most depth items are prepared ahead of the one being consumed, depth=0 prepares every item inline.
+    Any randomness inside make_item should come from item_rng, so the items do not depend on the timing of the threads.
+    The threads use the current cuda device of the thread iterating, which torch.cuda.set_device does not carry over to new threads.
+    """
+
+    def __init__(self, make_item, n_items, depth=0, num_workers=1, start=0):
+        self.make_item = make_item
+        self.n_items = n_items
+        self.depth = depth
+        self.num_workers = num_workers
+        self.start = start
+
+
+    def __len__(self):
+        return max(self.n_items - self.start, 0)
+
+
+    def __iter__(self):
+        if self.depth == 0:
+            for index in range(self.start, self.n_items):
+                yield self.make_item(index)
+            return
+
+        initializer = None
+        if torch.cuda.is_available():
+            device = torch.cuda.current_device()
+            initializer = lambda: torch.cuda.set_device(device)
+
+        with ThreadPoolExecutor(max_workers=self.num_workers, initializer=initializer) as pool:
+            pending = deque()
+            next_index = self.start
+            while pending or next_index < self.n_items:
+                ###The bounded queue: the item being consumed plus depth items ahead
+                while next_index < self.n_items and len(pending) <= self.depth:
+                    pending.append(pool.submit(self.make_item, next_index))
+                    next_index += 1
+                yield pending.popleft().result()
+
+
 ###Based on Function Vector: https://github.com/ericwtodd/function_vectors/blob/308e9d174cf0a1cf910b891d340f0dfd14168668/src/utils/extract_utils.py#L15
-def gather_last_attn_activations(inputs, model_helper):
+def gather_last_attn_activations(inputs, model_helper, last_token_only=False, token_positions=None, device="cuda"):
 
     """
     A function that performs a forward pass and extract the activation at certain location of the layer.
@@ -83,15 +144,62 @@ def gather_last_attn_activations(inputs, model_helper):
     Parameters:
     inputs: input to the model. Created with model_helper
     model_helper
+    last_token_only: Slice the activations inside the hook instead of retaining the full input and output of every layer.
+    token_positions: Only used with last_token_only. A (batch,) tensor with the position to keep in each row. Defaults to the last non-pad token.
+    device: Only used with last_token_only. The device the sliced activations are copied to.
 
     Returns: 
-    td: The attention activations.
+    td: The attention activations. With last_token_only, a dict {layer_name: (batch, residual_dim) activation} of the kept position.
     result: The output logits from forward method.
     """
 
-    with TraceDict(model_helper.model, layers=model_helper.model_config['attn_hook_names'], retain_input=True, retain_output=True) as td:                
+    if not last_token_only:
+        with TraceDict(model_helper.model, layers=model_helper.model_config['attn_hook_names'], retain_input=True, retain_output=True) as td:                
+            result = model_helper.forward(inputs)
+        return td, result
+
+    if token_positions is None:
+        token_positions = last_token_positions(inputs)
+
+    captured = {}
+    def capture_act(output, layer_name, inputs):
+        if isinstance(inputs, tuple):
+            inputs = inputs[0]
+
+        if token_positions is None:
+            cur_slice = inputs[:, -1]
+        else:
+            rows = torch.arange(inputs.shape[0], device=inputs.device)
+            cur_slice = inputs[rows, token_positions.to(inputs.device)]
+        captured[layer_name] = cur_slice.detach().to(device)
+        return output
+
+    with TraceDict(model_helper.model, layers=model_helper.model_config['attn_hook_names'], edit_output=capture_act):
         result = model_helper.forward(inputs)
-    return td, result
+    return captured, result
+
+
+def last_token_positions(model_input):
+
+    """
+    Position of the last non-pad token of every row, read from the attention mask.
+
+    Returns: 
+    A (batch,) LongTensor, or None when the input has no attention mask or is left padded. The last token is then simply position -1.
+    """
+
+    ###ViLA inputs are tuples, and the image tokens are only expanded inside the model
+    if isinstance(model_input, tuple) or "attention_mask" not in model_input:
+        return None
+
+    attention_mask = model_input["attention_mask"]
+    if bool(attention_mask[:, -1].all()):
+        return None
+
+    ###Index of the last 1 in every row
+    seq_len = attention_mask.shape[1]
+    positions = torch.arange(seq_len, device=attention_mask.device).unsqueeze(dim=0) * attention_mask.long()
+    return positions.argmax(dim=1)
 
 
 ###Based on Function Vector: https://github.com/ericwtodd/function_vectors/blob/308e9d174cf0a1cf910b891d340f0dfd14168668/src/utils/extract_utils.py#L65
@@ -111,11 +219,86 @@ def split_activations_by_head(activations, model_config):
 
     new_shape = activations.size()[:-1] + (model_config['n_heads'], model_config['resid_dim']//model_config['n_heads']) # split by head: + (n_attn_heads, hidden_size/n_attn_heads)
     activations = activations.view(*new_shape)  # (batch_size, n_tokens, n_heads, head_hidden_dim)
-    return activations.to("cuda")
+    return activations
+
+
+class RunningActivationStats:
+
+    """
+    Streaming mean of activations, and optionally their variance (Welford / Chan et al. parallel update).
+    Everything is kept in fp32 and the memory does not grow with the number of trials.
+    """
+
+    def __init__(self, track_var=False):
+        self.track_var = track_var
+        self.count = 0
+        self.mean = None
+        self.m2 = None
+
+
+    def update(self, activations):
+
+        """
+        activations: A batch of trials with the trial dimension first, e.g. (n, layer, head, 1, residual_dim)
+        """
+
+        activations = activations.float()
+        n_new = activations.shape[0]
+        mean_new = activations.mean(dim=0)
+
+        if self.mean is None:
+            self.mean = torch.zeros_like(mean_new)
+            if self.track_var:
+                self.m2 = torch.zeros_like(mean_new)
+
+        delta = mean_new - self.mean
+        total = self.count + n_new
+        self.mean += delta * (n_new / total)
+        if self.track_var:
+            m2_new = ((activations - mean_new) ** 2).sum(dim=0)
+            self.m2 += m2_new + delta ** 2 * (self.count * n_new / total)
+        self.count = total
+
+
+    def variance(self):
+
+        """
+        Unbiased variance of every entry. Only available with track_var=True.
+        """
+
+        return self.m2 / max(self.count - 1, 1)
+
+
+    def sums(self):
+
+        """
+        (sum, sum_sq, count) of the trials, in fp64. Unlike the mean and m2, these merge across workers by plain addition.
+        Only available with track_var=True.
+        """
+
+        mean = self.mean.double()
+        return mean * self.count, self.m2.double() + mean ** 2 * self.count, self.count
+
+
+def open_activation_storage(shape, dtype, device, spill_path=None):
+
+    """
+    Preallocates the per trial storage used by get_last_mean_head_activations(no_mean=True).
+    With spill_path the storage is a .npy file opened as a memmap, so the trials never stay on the GPU.
+    """
+
+    if spill_path is None:
+        return torch.empty(shape, dtype=dtype, device=device)
+
+    ###numpy has no bfloat16
+    np_dtype = np.float16 if dtype == torch.float16 else np.float32
+    storage = np.lib.format.open_memmap(spill_path, mode="w+", dtype=np_dtype, shape=shape)
+    return torch.from_numpy(storage)
 
 
 ###Based on Function Vector: https://github.com/ericwtodd/function_vectors/blob/308e9d174cf0a1cf910b891d340f0dfd14168668/src/utils/extract_utils.py#L46
-def get_last_mean_head_activations(dataset, model_helper, N_TRIALS = 50, shot=4, no_mean=False):
+def get_last_mean_head_activations(dataset, model_helper, N_TRIALS = 50, shot=4, no_mean=False, return_var=False, spill_path=None, last_token_only=True, batch_size=1,
+                                   prefetch_depth=0, prefetch_workers=1, data_seed=None, trials=None, return_stats=False):
 
     """
     This function extracts the activation of the last input token.
@@ -126,37 +309,187 @@ def get_last_mean_head_activations(dataset, model_helper, N_TRIALS = 50, shot=4,
     N_TRIALS: How many example to average the activation over
     shot: Number of shots per example
     no_mean: Whether you want to take the mean of the examples or save it for other preprocess
+    return_var: Also return the per entry variance over the trials
+    spill_path: Only used with no_mean. Writes the per trial activations to this .npy file instead of keeping them on the GPU.
+    last_token_only: Keep only the last token inside the hooks instead of retaining every layer's full input and output. Refer to gather_last_attn_activations.
+    batch_size: Number of few-shot prompts that are left padded into one forward pass. Batches always use last_token_only.
+    prefetch_depth, prefetch_workers: Number of batches prepared ahead, and threads preparing them. Refer to Prefetcher.
+    data_seed: Seed of the few-shot sampling. Trial n is always sampled with item_rng(data_seed, n). Drawn from random when None.
+    trials: Indices of the trials to run, range(N_TRIALS) when None. Refer to shard_trials.
+    return_stats: Return the RunningActivationStats of the trials, with the variance tracked, instead of the mean
 
     Returns: 
     mean_activations: It has the dimension of (layer, head, Token_len, residual_dim) or (N_TRIALS, layer, head, Token_len, residual_dim). Token_len is set to 1 in this case.
+                      The mean is computed as a running mean in fp32. With return_var, (mean_activations, var_activations) is returned.
     """
 
     activation_storage = None
+    activation_stats = RunningActivationStats(track_var=return_var or return_stats)
+
+    if batch_size > 1:
+        last_token_only = True
+    if data_seed is None:
+        data_seed = random.getrandbits(32)
+    trials = list(range(N_TRIALS)) if trials is None else list(trials)
+    N_TRIALS = len(trials)
 
-    for n in tqdm(range(N_TRIALS)):
+    def prepare_batch(batch_index):
+        start = batch_index * batch_size
+        formatted = [model_helper.format_func(dataset, None, num_shot=shot, model_helper=model_helper, rng=item_rng(data_seed, trial)) for trial in trials[start:start + batch_size]]
+        if batch_size == 1:
+            return model_helper.insert_image(formatted[0][0], formatted[0][1])
+        return model_helper.insert_image_batch([item[0] for item in formatted], [item[1] for item in formatted])
 
-        text, image_list, _, _ = model_helper.format_func(dataset, None, num_shot=shot, model_helper=model_helper)
-        inputs = model_helper.insert_image(text, image_list)
-        activations_td, result= gather_last_attn_activations(inputs, model_helper)
+    batches = Prefetcher(prepare_batch, (N_TRIALS + batch_size - 1) // batch_size, depth=prefetch_depth, num_workers=prefetch_workers)
 
+    for batch_index, inputs in enumerate(tqdm(batches)):
 
-        stack_initial = torch.vstack([split_activations_by_head(activations_td[layer].input, model_helper.model_config) for layer in model_helper.model_config['attn_hook_names']]).permute(0,2,1,3)
-        ###Extracting only the activation of the last input_token, as seen in the -1 indexing
-        cur_activation = stack_initial[:, :, -1, :].unsqueeze(dim=2).unsqueeze(dim=0)
-        if activation_storage is None:
-            activation_storage = cur_activation
+        n = batch_index * batch_size
+        cur_batch_size = min(batch_size, N_TRIALS - n)
+        activations_td, result= gather_last_attn_activations(inputs, model_helper, last_token_only=last_token_only)
+
+        if last_token_only:
+            ###(batch, layer, head, 1, head_dim). The hooks already kept only the last input token. The layers can sit on different devices, so they are gathered on one.
+            cur_activation = torch.stack([split_activations_by_head(activations_td[layer], model_helper.model_config).to("cuda") for layer in model_helper.model_config['attn_hook_names']], dim=1).unsqueeze(dim=3)
+        else:
+            stack_initial = torch.vstack([split_activations_by_head(activations_td[layer].input, model_helper.model_config).to("cuda") for layer in model_helper.model_config['attn_hook_names']]).permute(0,2,1,3)
+            ###Extracting only the activation of the last input_token, as seen in the -1 indexing
+            cur_activation = stack_initial[:, :, -1, :].unsqueeze(dim=2).unsqueeze(dim=0)
+        if no_mean:
+            if activation_storage is None:
+                activation_storage = open_activation_storage((N_TRIALS,) + cur_activation.shape[1:], cur_activation.dtype, cur_activation.device, spill_path=spill_path)
+            activation_storage[n:n + cur_batch_size] = cur_activation.to(activation_storage.device, activation_storage.dtype)
         else:
+            activation_stats.update(cur_activation)
 
-            activation_storage = torch.vstack((activation_storage, cur_activation))
     if no_mean:
         return activation_storage
+    if return_stats:
+        return activation_stats
     
-    mean_activations = activation_storage.mean(dim=0)
-    
+    mean_activations = activation_stats.mean
+
+    if return_var:
+        return mean_activations, activation_stats.variance()
     return mean_activations
 
 
-def reinforce(mean_activations, model_helper, reinforce_data, eval_data):
+def shard_trials(n_trials, shard, num_shards):
+
+    """
+    The trials of worker shard out of num_shards. Every trial goes to exactly one shard, and as trial n is always sampled with
+    item_rng(data_seed, n), the merged shards average over the same prompts as a single run.
+    """
+
+    if not 0 <= shard < num_shards:
+        raise ValueError(f"shard {shard} is out of range for {num_shards} shards")
+    if num_shards > n_trials:
+        raise ValueError(f"{num_shards} shards for {n_trials} trials would leave some shards empty")
+    return range(shard, n_trials, num_shards)
+
+
+def save_activation_sums(path, activation_stats, shard, num_shards, n_trials, data_seed, extraction_key=""):
+
+    """
+    Writes the sufficient statistics of one shard (per entry sum and sum of squares, and the trial count) to an .npz file, atomically.
+    The shard settings are stored with them so that reduce_activation_sums can check that the shards belong together.
+    extraction_key is the build_cache_key of the extraction (model, dataset, train file, shots), the same for every shard.
+    """
+
+    total, total_sq, count = activation_stats.sums()
+    ###A hidden name without the .npz suffix, so a worker killed mid write never leaves a file that looks like a shard
+    tmp_path = os.path.join(os.path.dirname(path), "." + os.path.basename(path) + ".tmp")
+    with open(tmp_path, "wb") as f:
+        np.savez(f, sum=total.cpu().numpy(), sum_sq=total_sq.cpu().numpy(), count=count,
+                 shard=shard, num_shards=num_shards, n_trials=n_trials, data_seed=data_seed, extraction_key=extraction_key)
+    os.replace(tmp_path, path)
+
+
+def reduce_activation_sums(paths):
+
+    """
+    Merges the shard files written by save_activation_sums.
+
+    Parameters:
+    paths: One file per shard. Every shard of the extraction must be present exactly once.
+
+    Returns: 
+    mean_activations: (layer, head, 1, residual_dim), fp32, as get_last_mean_head_activations returns it
+    var_activations: Unbiased per entry variance over all trials
+    count: Number of trials
+    """
+
+    total, total_sq, count = None, None, 0
+    settings, seen = None, set()
+    for path in paths:
+        with np.load(path) as shard_file:
+            cur_settings = tuple(int(shard_file[name]) for name in ["num_shards", "n_trials", "data_seed"]) + (str(shard_file["extraction_key"]),)
+            if settings is not None and cur_settings != settings:
+                raise ValueError(f"{path} was extracted with (num_shards, n_trials, data_seed, extraction_key) = {cur_settings}, the other shards with {settings}")
+            settings = cur_settings
+            shard = int(shard_file["shard"])
+            if shard in seen:
+                raise ValueError(f"shard {shard} is given twice")
+            seen.add(shard)
+
+            if total is None:
+                total, total_sq = shard_file["sum"].astype(np.float64), shard_file["sum_sq"].astype(np.float64)
+            else:
+                total += shard_file["sum"]
+                total_sq += shard_file["sum_sq"]
+            count += int(shard_file["count"])
+
+    if settings is None:
+        raise ValueError("no shard files to reduce")
+    missing = sorted(set(range(settings[0])) - seen)
+    if missing:
+        raise ValueError(f"missing shards {missing} of {settings[0]}")
+
+    mean = total / count
+    ###Clipped, the subtraction can go slightly negative in floating point
+    var = np.maximum(total_sq - total * mean, 0) / max(count - 1, 1)
+    return torch.from_numpy(mean).float(), torch.from_numpy(var).float(), count
+
+
+def prepare_reinforce_input(model_helper, reinforce_data, rng):
+
+    """
+    Samples one REINFORCE example and returns (model_input, target_token), with target_token the first token of the answer.
+    """
+
+    text, image_list, target_out, _ = model_helper.format_func(reinforce_data, None, num_shot=0, model_helper=model_helper, rng=rng)
+    new_input = model_helper.insert_image(text, image_list)
+    return new_input, first_answer_tokens(model_helper, [target_out])
+
+
+def first_answer_tokens(model_helper, answers):
+
+    """
+    First token of every answer, the token that the REINFORCE, validation and scoring losses are taken on.
+
+    Parameters:
+    answers: Answer strings. A list answer (several valid answers) uses its first entry.
+
+    Returns: 
+    A (len(answers),) tensor of token ids, on the model device
+    """
+
+    token_ids = []
+    for answer in answers:
+        if type(answer) == list:
+            answer = answer[0]
+        if model_helper.space:
+            answer = " " + answer
+        token_ids.append(model_helper.tokenizer(answer, return_tensors='pt')["input_ids"][0][model_helper.nonspecial_idx].item())
+
+    ###An explicit device, the inputs can be prepared on prefetch threads where the current cuda device is not set
+    return torch.tensor(token_ids, device=model_helper.model.device)
+
+
+def reinforce(mean_activations, model_helper, reinforce_data, eval_data, rollout_batch_size=None, use_prefix_cache=False, prefetch_depth=0, prefetch_workers=1, data_seed=None, eval_batch_size=None,
+              checkpoint_path=None, checkpoint_every=50, resume=False, n_epochs=600, lr=0.1, num_samples=32, patience=None, prob_tol=None, entropy_threshold=None,
+              estimator="normalized", baseline_decay=0.9, antithetic=False, adaptive_samples=False, min_samples=8, noise_target=1.0, distributed=False,
+              settings_key=None):
 
     """
     This function performs Reinforce to select the attentions that encodes ICL examples.
@@ -166,6 +499,23 @@ def reinforce(mean_activations, model_helper, reinforce_data, eval_data):
     model_helper:
     reinforce_data: Dataset used during reinforce optimization
     eval_data: Dataset used for Validation
+    rollout_batch_size: If set, the sampled head masks are stacked as batch rows and evaluated this many at a time. None runs one forward per sample.
+    use_prefix_cache: Run the prompt without its last token once per epoch and only replay the intervened last token for every sample.
+    prefetch_depth, prefetch_workers: Number of epochs whose inputs are prepared ahead, and threads preparing them. Refer to Prefetcher.
+    data_seed: Seed of the example sampling. Epoch i always uses item_rng(data_seed, i). Drawn from random when None.
+    eval_batch_size: If set, validation runs this many eval items per forward pass. Refer to validate_reinforce.
+    checkpoint_path: If set, the optimization state is saved to this file every checkpoint_every epochs and at the end. Refer to save_reinforce_checkpoint.
+    resume: Continue from checkpoint_path if it exists. The remaining epochs follow the same trajectory as an uninterrupted run.
+    n_epochs, lr, num_samples: Maximum number of epochs, Adam learning rate, and head masks sampled per epoch
+    patience, prob_tol, entropy_threshold: Early stopping criteria, all off when None. Refer to reinforce_stop_reason.
+    estimator, baseline_decay: How the losses are turned into advantages. Refer to reinforce_advantages.
+    antithetic: Sample the masks in antithetic pairs. Refer to sample_head_masks.
+    adaptive_samples: Start every epoch with min_samples masks and add as many again, up to num_samples, while the estimated variance of the gradient
+                      is more than noise_target times its squared norm. Refer to gradient_noise_ratio.
+    distributed: Data parallel over the initialized torch.distributed group. Every rank holds a model replica and gets the masks sampled by rank 0,
+                 evaluates its shard of them and gets the other losses from an all_reduce, so all ranks take the same Adam step.
+                 Validation and checkpoints run on rank 0.
+    settings_key: Key of the run settings (e.g. the REINFORCE build_cache_key), stored in the checkpoint. A checkpoint with another key is not resumed.
 
     Returns: 
     bernoullis: A tensor of bernoullis variable. One variable for each attention heads. Each denote the probability of selecting this attention head.
@@ -173,66 +523,393 @@ def reinforce(mean_activations, model_helper, reinforce_data, eval_data):
 
     num_layer = model_helper.model_config["n_layers"]
     num_heads = model_helper.model_config["n_heads"]
-    lr = 0.1
     eps = 1e-3
-    epoch = 600
+    ###Placed once, every rollout hook then reads the task vector from its own layer's device
+    mean_activations = place_activations(mean_activations, model_helper.model, model_helper.model_config, split_idx=model_helper.split_idx)
 
     #(num_layer, num_head)
     bernoullis = [torch.neg(torch.ones(num_heads)).requires_grad_() for _ in range(num_layer)]
     optim = torch.optim.Adam(bernoullis, lr=lr)
+    start_epoch, val_history, total_unique, total_samples, baseline = 0, [], 0, 0, None
+    is_main = not distributed or dist_info()[0] == 0
+
+    ###All ranks prepare the examples with the seed of rank 0
+    if distributed:
+        data_seed = int(broadcast_value(data_seed if data_seed is not None else random.getrandbits(32), dtype=torch.long))
+
+    if resume and checkpoint_path is not None and os.path.exists(checkpoint_path):
+        checkpoint = load_reinforce_checkpoint(checkpoint_path, bernoullis, optim, settings_key=settings_key)
+        start_epoch, data_seed, val_history = checkpoint["epoch"], checkpoint["data_seed"], checkpoint["val_history"]
+        total_unique = checkpoint["extra"].get("total_unique", 0)
+        total_samples = checkpoint["extra"].get("total_samples", 0)
+        baseline = checkpoint["extra"].get("baseline")
+        ###A run that already stopped early is finished, its checkpoint is returned as it is
+        if checkpoint["extra"].get("stop_reason") is not None:
+            print(f"reinforce already stopped after {start_epoch} epochs: {checkpoint['extra']['stop_reason']}")
+            return bernoullis
+        print(f"resuming reinforce from epoch {start_epoch} of {checkpoint_path}")
+
+    if data_seed is None:
+        data_seed = random.getrandbits(32)
+    epoch_inputs = Prefetcher(lambda index: prepare_reinforce_input(model_helper, reinforce_data, item_rng(data_seed, index)), n_epochs,
+                              depth=prefetch_depth, num_workers=prefetch_workers, start=start_epoch)
+
+    progress = tqdm(epoch_inputs, initial=start_epoch, total=n_epochs, disable=not is_main)
+    epoch = start_epoch - 1
     with torch.set_grad_enabled(True):
 
-        for epoch in tqdm(range(epoch)):
-            
-            loss_list = []
-            saved_log_probs = []
-
-            text, image_list, target_out, _ = model_helper.format_func(reinforce_data, None, num_shot=0, model_helper=model_helper)
-            new_input = model_helper.insert_image(text, image_list)
-
-            if type(target_out)==list:
-                target_out = target_out[0]
-
-            if model_helper.space:
-                target_out = " " + target_out
+        for epoch, (new_input, target_token) in enumerate(progress, start=start_epoch):
 
-            target_token = model_helper.tokenizer(target_out, return_tensors='pt')["input_ids"][0][model_helper.nonspecial_idx].unsqueeze(dim=0).to("cuda")
             sigmoid_tensor = torch.stack([torch.sigmoid(bernoulli).clamp(min=eps, max=1-eps) for bernoulli in bernoullis])
             prob_dist = torch.distributions.Bernoulli(sigmoid_tensor)
+            prefix_cache = build_prefix_cache(new_input, model_helper) if use_prefix_cache else None
 
 
             ###Sampling the distribution many times to reduce variance.
-            for _ in range(32):
-
-                ##Current sample
-                sampled = prob_dist.sample()
-                saved_log_probs.append(prob_dist.log_prob(sampled))
-
-                with torch.no_grad():
-                    out_logit = reinforce_activation_replacement(new_input, mean_activations, model_helper, sampled, last_token_only=True)
-                    task_loss = torch.nn.functional.cross_entropy(out_logit, target_token)
-                    loss_list.append(task_loss)
+            ###Once the bernoullis saturate many samples are the same mask. Every distinct mask is only evaluated once per epoch.
+            epoch_losses = {}
+            ##(n_samples, num_layer, num_head)
+            sampled = sample_head_masks(prob_dist, min_samples if adaptive_samples else num_samples, antithetic=antithetic)
+            if distributed:
+                sampled = broadcast_tensor(sampled)
+            with torch.no_grad():
+                loss_list = rollout_losses(new_input, mean_activations, model_helper, sampled, target_token, epoch_losses, rollout_batch_size=rollout_batch_size, prefix_cache=prefix_cache,
+                                           distributed=distributed)
+
+                ###More rollouts on the same input while the gradient estimate is dominated by noise
+                while adaptive_samples and sampled.shape[0] < num_samples:
+                    advantages, _ = reinforce_advantages(loss_list, estimator, baseline, baseline_decay, eps)
+                    if gradient_noise_ratio(sampled, advantages, sigmoid_tensor.detach()) <= noise_target:
+                        break
+                    more_sampled = sample_head_masks(prob_dist, min(sampled.shape[0], num_samples - sampled.shape[0]), antithetic=antithetic)
+                    if distributed:
+                        more_sampled = broadcast_tensor(more_sampled)
+                    more_losses = rollout_losses(new_input, mean_activations, model_helper, more_sampled, target_token, epoch_losses, rollout_batch_size=rollout_batch_size, prefix_cache=prefix_cache,
+                                                 distributed=distributed)
+                    sampled, loss_list = torch.cat([sampled, more_sampled]), torch.cat([loss_list, more_losses])
+
+            saved_log_probs = prob_dist.log_prob(sampled)
+            n_unique = len(epoch_losses)
+            total_unique += n_unique
+            total_samples += sampled.shape[0]
+            progress.set_postfix(unique_masks=f"{n_unique}/{sampled.shape[0]}")
 
             #print(model_helper.tokenizer.decode(out_logit[0].argmax(dim=-1)), model_helper.tokenizer.decode(target_token[0]), flush=True)
 
-            policy_loss = []
-            loss_list = torch.tensor(loss_list)
-            loss_list = (loss_list - loss_list.mean())/(loss_list.std() + eps)
-
-            for log_prob, R in zip(saved_log_probs, loss_list):
-                policy_loss.append(log_prob * R)
+            loss_list, baseline = reinforce_advantages(loss_list, estimator, baseline, baseline_decay, eps)
 
+            prev_probs = sigmoid_tensor.detach()
             optim.zero_grad()
-            policy_loss = torch.cat(policy_loss).sum()
+            policy_loss = (saved_log_probs * loss_list.view(-1, 1, 1)).sum()
             policy_loss.backward()
             optim.step()
             torch.cuda.empty_cache()
             if epoch % 50 == 0:
-                validate_reinforce(model_helper, bernoullis, eps, mean_activations, eval_data, epoch)
+                ##Validated on rank 0, the loss is shared for early stopping
+                val_loss = validate_reinforce(model_helper, bernoullis, eps, mean_activations, eval_data, epoch, use_prefix_cache=use_prefix_cache,
+                                              eval_batch_size=eval_batch_size) if is_main else 0.0
+                if distributed:
+                    val_loss = broadcast_value(val_loss)
+                val_history.append((epoch, val_loss))
+
+            stop_reason = reinforce_stop_reason(bernoullis, prev_probs, val_history, eps, patience=patience, prob_tol=prob_tol, entropy_threshold=entropy_threshold)
+            if is_main and checkpoint_path is not None and ((epoch + 1) % checkpoint_every == 0 or epoch + 1 == n_epochs or stop_reason is not None):
+                save_reinforce_checkpoint(checkpoint_path, bernoullis, optim, epoch + 1, data_seed, val_history,
+                                          extra={"total_unique": total_unique, "total_samples": total_samples, "baseline": baseline, "stop_reason": stop_reason},
+                                          settings_key=settings_key)
+            if stop_reason is not None:
+                print(f"reinforce stopped after {epoch + 1} of {n_epochs} epochs: {stop_reason}")
+                break
+
+    if is_main:
+        print(f"rollouts: {total_unique} distinct masks evaluated out of {total_samples} samples ({total_unique / max(total_samples, 1):.0%})")
     return bernoullis
 
 
-def validate_reinforce(model_helper, bernoullis, eps, mean_activations, eval_data, epoch, sampled=None):
+def dist_info():
+
+    """
+    (rank, world_size) of the torch.distributed group, or (0, 1) when it is not initialized.
+    """
+
+    if torch.distributed.is_available() and torch.distributed.is_initialized():
+        return torch.distributed.get_rank(), torch.distributed.get_world_size()
+    return 0, 1
+
+
+def collective_device():
+
+    """
+    nccl only reduces cuda tensors, gloo works on cpu.
+    """
+
+    return "cuda" if torch.distributed.get_backend() == "nccl" else "cpu"
+
+
+def broadcast_value(value, dtype=torch.float64):
+
+    """
+    Returns the value of rank 0 on every rank.
+    """
+
+    tensor = torch.tensor([value], dtype=dtype, device=collective_device())
+    torch.distributed.broadcast(tensor, src=0)
+    return tensor.item()
+
+
+def broadcast_tensor(tensor):
+
+    """
+    Returns the tensor of rank 0 on every rank, on the device of the given tensor. Shapes must match across ranks.
+    """
+
+    shared = tensor.to(collective_device()).contiguous()
+    torch.distributed.broadcast(shared, src=0)
+    return shared.to(tensor.device)
+
+
+def sample_head_masks(prob_dist, n, antithetic=False):
+
+    """
+    Samples n (layer, head) masks from prob_dist, as a (n, layer, head) tensor.
+
+    With antithetic, the masks come in pairs that share one uniform draw u: (u < p) and (1 - u < p). Each mask still has the right distribution,
+    but the two are negatively correlated, which lowers the variance of the averaged gradient.
+    """
+
+    if not antithetic:
+        return prob_dist.sample((n,))
+
+    probs = prob_dist.probs
+    uniform = torch.rand(((n + 1) // 2,) + probs.shape)
+    uniform = torch.cat([uniform, 1 - uniform])[:n]
+    return (uniform < probs).float()
+
+
+def rollout_losses(model_input, mean_activations, model_helper, sampled, target_token, memo, rollout_batch_size=None, prefix_cache=None, distributed=False):
+
+    """
+    Cross entropy of every sampled mask on model_input. Masks already in memo (a dict from mask_key to loss, kept for one epoch) are not run again.
+
+    Parameters:
+    sampled: (n, layer, head) masks
+    rollout_batch_size: If set, the new masks are evaluated as batch rows, this many per forward pass. Refer to batched_rollout_loss.
+    prefix_cache: From build_prefix_cache
+    distributed: Every rank gets the same sampled. Rank r evaluates every world_size-th new mask starting at r, and the losses are summed across ranks.
+
+    Returns: 
+    A (n,) tensor of losses, on cpu
+    """
+
+    keys = [mask_key(cur_sampled) for cur_sampled in sampled]
+    new_rows = {}
+    for i, key in enumerate(keys):
+        if key not in memo and key not in new_rows:
+            new_rows[key] = i
+
+    if new_rows:
+        new_keys = list(new_rows)
+        rank, world_size = dist_info() if distributed else (0, 1)
+        own_keys = new_keys[rank::world_size]
+
+        own_losses = {}
+        if rollout_batch_size is None:
+            for key in own_keys:
+                out_logit = reinforce_activation_replacement(model_input, mean_activations, model_helper, sampled[new_rows[key]], last_token_only=True, prefix_cache=prefix_cache)
+                own_losses[key] = torch.nn.functional.cross_entropy(out_logit, target_token).item()
+        elif own_keys:
+            new_losses = batched_rollout_loss(model_input, mean_activations, model_helper, sampled[[new_rows[key] for key in own_keys]], target_token, rollout_batch_size, prefix_cache=prefix_cache)
+            own_losses.update(zip(own_keys, new_losses.tolist()))
+
+        if world_size > 1:
+            ##Each loss is only non zero on the rank that computed it
+            all_losses = torch.zeros(len(new_keys), dtype=torch.float64)
+            all_losses[rank::world_size] = torch.tensor([own_losses[key] for key in own_keys], dtype=torch.float64)
+            all_losses = all_losses.to(collective_device())
+            torch.distributed.all_reduce(all_losses)
+            own_losses = dict(zip(new_keys, all_losses.tolist()))
+        memo.update(own_losses)
+
+    return torch.tensor([memo[key] for key in keys])
+
+
+def reinforce_advantages(loss_list, estimator, baseline, baseline_decay, eps):
+
+    """
+    Turns the losses of the sampled masks into the weights of their log probabilities in the policy loss.
+
+    estimator:
+    "normalized": (loss - mean) / std over the samples of the epoch
+    "leave_one_out": loss minus the mean loss of the other samples of the epoch. Unbiased, needs at least 2 samples.
+    "moving_average": loss minus an exponential moving average (baseline_decay) of the mean loss over the previous epochs
+
+    Returns: 
+    advantages, and the baseline to pass to the next epoch (only used by "moving_average")
+    """
+
+    if estimator == "normalized":
+        return (loss_list - loss_list.mean())/(loss_list.std() + eps), baseline
+
+    if estimator == "leave_one_out":
+        n = loss_list.shape[0]
+        return loss_list - (loss_list.sum() - loss_list) / max(n - 1, 1), baseline
+
+    if estimator == "moving_average":
+        cur_baseline = loss_list.mean().item() if baseline is None else baseline
+        return loss_list - cur_baseline, baseline_decay * cur_baseline + (1 - baseline_decay) * loss_list.mean().item()
+
+    raise ValueError(f"Unknown estimator {estimator}")
+
+
+def gradient_noise_ratio(sampled, advantages, probs):
+
+    """
+    Variance of the REINFORCE gradient estimate divided by its squared norm. The gradient of log Bernoulli(m; sigmoid(logit)) with respect to
+    the logit is m - p, so every sample's contribution is advantage * (m - p), and no backward pass is needed.
+    """
+
+    per_sample = advantages.view(-1, 1, 1) * (sampled - probs)
+    noise = per_sample.var(dim=0).sum() / per_sample.shape[0]
+    return (noise / (per_sample.mean(dim=0).pow(2).sum() + 1e-12)).item()
+
+
+def reinforce_stop_reason(bernoullis, prev_probs, val_history, eps, patience=None, prob_tol=None, entropy_threshold=None):
+
+    """
+    Convergence check of reinforce and avg_reinforce, run after every optimizer step.
+
+    Parameters:
+    bernoullis: The bernoulli logits after the step
+    prev_probs: (layer, head) clamped probabilities before the step
+    val_history: List of (epoch, validation loss)
+    eps: The clamp of the probabilities
+    patience: Stop when the best validation loss is more than patience validations old
+    prob_tol: Stop when no head probability moved more than prob_tol in the last step
+    entropy_threshold: Stop when the mean entropy (in nats) of the head bernoullis is below entropy_threshold, i.e. the masks are almost deterministic
+
+    Returns: 
+    A description of the criterion that was met, or None to keep going
+    """
+
+    probs = torch.stack([torch.sigmoid(bernoulli.detach()).clamp(min=eps, max=1-eps) for bernoulli in bernoullis])
+
+    if patience is not None and len(val_history) > patience:
+        losses = [loss for _, loss in val_history]
+        best = min(range(len(losses)), key=losses.__getitem__)
+        if len(losses) - 1 - best >= patience:
+            return f"validation loss has not improved for {patience} validations (best {losses[best]:.4f} at epoch {val_history[best][0]})"
+
+    if prob_tol is not None:
+        max_change = (probs - prev_probs).abs().max().item()
+        if max_change < prob_tol:
+            return f"largest probability change {max_change:.2e} is below {prob_tol}"
+
+    if entropy_threshold is not None:
+        entropy = -(probs * probs.log() + (1 - probs) * (1 - probs).log()).mean().item()
+        if entropy < entropy_threshold:
+            return f"mean mask entropy {entropy:.4f} is below {entropy_threshold}"
+
+    return None
+
+
+def save_reinforce_checkpoint(path, bernoullis, optim, epoch, data_seed, val_history, extra=None, settings_key=None):
+
+    """
+    Atomically saves everything reinforce and avg_reinforce need to continue: the bernoulli logits, the Adam state, the torch and python RNG states
+    (the head masks are sampled from the torch RNG), the number of finished epochs, the data seed and the validation history.
+    The file is written next to path first and then renamed, so a preempted job never leaves a partial checkpoint.
+    settings_key identifies the run settings, refer to load_reinforce_checkpoint.
+    """
+
+    state = {"bernoullis": [bernoulli.detach().clone() for bernoulli in bernoullis],
+             "optim": optim.state_dict(),
+             "epoch": epoch,
+             "data_seed": data_seed,
+             "val_history": val_history,
+             "extra": extra or {},
+             "settings_key": settings_key,
+             "torch_rng": torch.get_rng_state(),
+             "cuda_rng": torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None,
+             "python_rng": random.getstate()}
+
+    tmp_path = path + ".tmp"
+    torch.save(state, tmp_path)
+    os.replace(tmp_path, path)
+
+
+def load_reinforce_checkpoint(path, bernoullis, optim, settings_key=None):
+
+    """
+    Restores a checkpoint from save_reinforce_checkpoint into bernoullis and optim in place, and restores the RNG states.
+    Raises ValueError, before restoring anything, when the checkpoint was written with another settings_key.
+
+    Returns: 
+    The checkpoint dict, with the epoch to continue from, the data seed, the validation history and the extra state.
+    extra["stop_reason"] is set when the run stopped early, and such a run is not continued.
+    """
+
+    state = torch.load(path)
+    if state.get("settings_key") != settings_key:
+        raise ValueError(f"{path} was written by a run with other settings (key {state.get('settings_key')}, this run {settings_key}), "
+                         "use another --checkpoint_path or drop --resume")
+    with torch.no_grad():
+        for bernoulli, saved in zip(bernoullis, state["bernoullis"]):
+            bernoulli.copy_(saved)
+    optim.load_state_dict(state["optim"])
+
+    torch.set_rng_state(state["torch_rng"])
+    if state["cuda_rng"] is not None and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state["cuda_rng"])
+    random.setstate(state["python_rng"])
+    return state
+
+
+def mask_key(sampled):
+
+    """
+    Hashable key of a sampled head mask, used to evaluate every distinct mask only once.
+    """
+
+    return sampled.detach().cpu().to(torch.bool).numpy().tobytes()
+
+
+def batched_rollout_loss(model_input, mean_activations, model_helper, sampled, target_token, rollout_batch_size, prefix_cache=None):
+
+    """
+    Evaluates many sampled head masks on the same input by stacking them as batch rows.
+
+    Parameters:
+    model_input: Output of model_helper.insert_image for a single example
+    mean_activations: From get_last_mean_head_activations
+    model_helper:
+    sampled: Sampled head masks of shape (num_samples, layer, head)
+    target_token: Target token of shape (1,)
+    rollout_batch_size: Number of masks evaluated per forward pass. Lower it if the stacked batch does not fit in memory.
+    prefix_cache: From build_prefix_cache. Shared by every chunk.
+
+    Returns: 
+    loss_list: The cross entropy loss of each sampled mask, of shape (num_samples,). Kept on cpu.
+    """
+
+    loss_list = []
+    for chunk in sampled.split(rollout_batch_size):
+        out_logit = reinforce_activation_replacement(model_input, mean_activations, model_helper, chunk, last_token_only=True, prefix_cache=prefix_cache)
+        task_loss = torch.nn.functional.cross_entropy(out_logit, target_token.expand(chunk.shape[0]), reduction="none")
+        loss_list.append(task_loss.float().cpu())
+    return torch.cat(loss_list)
+
+
+def validate_reinforce(model_helper, bernoullis, eps, mean_activations, eval_data, epoch, sampled=None, use_prefix_cache=False, rollout_batch_size=None, eval_batch_size=None):
+
+    """
+    Computes the mean first token loss over eval_data with a sampled set of heads.
+
+    sampled can also be a (num_candidates, layer, head) stack of candidate masks. Each eval item is then prepared once and all candidates are scored on it,
+    and the mean loss of every candidate is returned as a list. With use_prefix_cache the prompt is only run once per item for all candidates.
+
+    With eval_batch_size, eval_data is instead prepared once by prepare_validation_set and run eval_batch_size items per forward pass,
+    one pass over the eval set per candidate. use_prefix_cache and rollout_batch_size are not used then.
+    """
 
     with torch.no_grad():
         if sampled is None:
@@ -240,14 +917,24 @@ def validate_reinforce(model_helper, bernoullis, eps, mean_activations, eval_dat
             prob_dist = torch.distributions.Bernoulli(sigmoid_tensor)
             sampled = prob_dist.sample()
 
+        ###Duplicate candidates are only scored once
+        if sampled.dim() == 3:
+            unique_sampled, inverse = torch.unique(sampled, dim=0, return_inverse=True)
+            print(f"validation: {unique_sampled.shape[0]} distinct masks out of {sampled.shape[0]} candidates")
+            if eval_batch_size is not None:
+                candidate_loss = [validate_batched(model_helper, mean_activations, eval_data, epoch, cur_sampled, eval_batch_size) for cur_sampled in unique_sampled]
+                return [candidate_loss[i] for i in inverse.tolist()]
+            candidate_loss = validate_candidates(model_helper, mean_activations, eval_data, epoch, unique_sampled, use_prefix_cache=use_prefix_cache, rollout_batch_size=rollout_batch_size)
+            return [candidate_loss[i] for i in inverse.tolist()]
+
+        if eval_batch_size is not None:
+            return validate_batched(model_helper, mean_activations, eval_data, epoch, sampled, eval_batch_size)
+
         loss_list = []
         for item in eval_data:
             text, image_list, target_out, _ = model_helper.format_func(None, item, num_shot=0, split="test", model_helper=model_helper)
             new_input = model_helper.insert_image(text, image_list)
-
-            if model_helper.space:
-                target_out = " " + target_out
-            target_token = model_helper.tokenizer(target_out, return_tensors='pt')["input_ids"][0][model_helper.nonspecial_idx].unsqueeze(dim=0).to("cuda")
+            target_token = first_answer_tokens(model_helper, [target_out])
 
 
             out_logit = reinforce_activation_replacement(new_input, mean_activations, model_helper, sampled, last_token_only=True)
@@ -260,7 +947,115 @@ def validate_reinforce(model_helper, bernoullis, eps, mean_activations, eval_dat
     return torch.tensor(loss_list).mean().item()
 
 
-def avg_reinforce(mean_activations, model_helper, reinforce_data, eval_data):
+##Prepared eval sets of the last few (model_helper, eval_data, batch_size) combinations. Refer to prepare_validation_set.
+validation_sets = OrderedDict()
+
+
+def prepare_validation_set(model_helper, eval_data, batch_size, max_sets=4):
+
+    """
+    Formats and tokenizes eval_data into left padded batches, once. Later calls with the same eval_data object reuse the prepared batches,
+    so validating every 50 epochs and scoring the head candidates skip the preprocessing.
+
+    Parameters:
+    model_helper:
+    eval_data: Dataset used for Validation. The prepared batches are keyed by this object, so pass the same object on every call.
+    batch_size: Number of eval items per batch
+    max_sets: Number of prepared eval sets that are kept
+
+    Returns: 
+    A list of (model_input, target_tokens), with target_tokens of shape (batch,)
+    """
+
+    key = (id(model_helper), id(eval_data), batch_size)
+    if key in validation_sets:
+        validation_sets.move_to_end(key)
+        return validation_sets[key][1]
+
+    batches = []
+    for start in range(0, len(eval_data), batch_size):
+        texts, image_lists, target_outs = [], [], []
+        for item in eval_data[start:start + batch_size]:
+            text, image_list, target_out, _ = model_helper.format_func(None, item, num_shot=0, split="test", model_helper=model_helper)
+            texts.append(text)
+            image_lists.append(image_list)
+            target_outs.append(target_out)
+
+        batches.append((model_helper.insert_image_batch(texts, image_lists), first_answer_tokens(model_helper, target_outs)))
+
+    ###eval_data is kept alive with its batches, so its id can not be reused by another dataset
+    validation_sets[key] = (eval_data, batches)
+    while len(validation_sets) > max_sets:
+        validation_sets.popitem(last=False)
+    return batches
+
+
+def validate_batched(model_helper, mean_activations, eval_data, epoch, sampled, eval_batch_size):
+
+    """
+    Mean first token loss over eval_data with one (layer, head) mask, run eval_batch_size items at a time. Refer to validate_reinforce.
+    """
+
+    loss_list = []
+    for model_input, target_tokens in prepare_validation_set(model_helper, eval_data, eval_batch_size):
+        out_logit = reinforce_activation_replacement(model_input, mean_activations, model_helper, sampled, last_token_only=True, batched_input=True)
+        loss_list.append(torch.nn.functional.cross_entropy(out_logit, target_tokens, reduction="none").float().cpu())
+
+    mean_loss = torch.cat(loss_list).mean()
+    print(f"validation loss at {epoch} epoch:", mean_loss)
+    return mean_loss.item()
+
+
+def validate_candidates(model_helper, mean_activations, eval_data, epoch, sampled, use_prefix_cache=False, rollout_batch_size=None):
+
+    """
+    Scores several candidate head masks on the same eval items. Refer to validate_reinforce.
+
+    Returns: 
+    A list with the mean loss of each candidate in sampled.
+    """
+
+    loss_list = []
+    for item in eval_data:
+        text, image_list, target_out, _ = model_helper.format_func(None, item, num_shot=0, split="test", model_helper=model_helper)
+        new_input = model_helper.insert_image(text, image_list)
+        target_token = first_answer_tokens(model_helper, [target_out])
+
+        prefix_cache = build_prefix_cache(new_input, model_helper) if use_prefix_cache else None
+        loss_list.append(batched_rollout_loss(new_input, mean_activations, model_helper, sampled, target_token, rollout_batch_size or sampled.shape[0], prefix_cache=prefix_cache))
+
+    ##(num_candidates,)
+    candidate_loss = torch.stack(loss_list).mean(dim=0)
+    print(f"validation loss at {epoch} epoch:", candidate_loss)
+    return candidate_loss.tolist()
+
+
+def prepare_avg_reinforce_input(model_helper, reinforce_data, rng):
+
+    """
+    Samples one example with its answer appended. Returns (model_input, labels, target_len), where labels only keep the answer tokens.
+    """
+
+    text, image_list, target_out, _ = model_helper.format_func(reinforce_data, None, num_shot=0, model_helper=model_helper, rng=rng)
+
+    if type(target_out)==list:
+        target_out = target_out[0]
+
+
+    ###Constructing a label for taking average loss
+    if model_helper.space:
+                    target_out = " " + target_out
+    # target_token = model_helper.tokenizer(target_out, return_tensors='pt')["input_ids"][0][model_helper.nonspecial_idx].unsqueeze(dim=0).to("cuda")
+    input_full = model_helper.insert_image(text, image_list, gt=target_out)
+    labels = input_full[0].clone()
+    target_len = model_helper.tokenizer(target_out, return_tensors='pt')["input_ids"][0].shape[0]
+    labels[:, :-target_len] = -100
+    return input_full, labels, target_len
+
+
+def avg_reinforce(mean_activations, model_helper, reinforce_data, eval_data, use_prefix_cache=False, prefetch_depth=0, prefetch_workers=1, data_seed=None, eval_batch_size=None,
+                  checkpoint_path=None, checkpoint_every=50, resume=False, n_epochs=600, lr=0.1, num_samples=8, patience=None, prob_tol=None, entropy_threshold=None,
+                  estimator="normalized", baseline_decay=0.9, settings_key=None):
 
     """
     This function performs Reinforce to select the attentions that encodes ICL examples.
@@ -271,6 +1066,9 @@ def avg_reinforce(mean_activations, model_helper, reinforce_data, eval_data):
     model_helper:
     reinforce_data: Dataset used during reinforce optimization
     eval_data: Dataset used for Validation
+    use_prefix_cache: Run the prompt once per epoch and only replay the target tokens (and the token before them) for every sample.
+    prefetch_depth, prefetch_workers, data_seed, eval_batch_size, checkpoint_path, checkpoint_every, resume, settings_key: Refer to reinforce.
+    n_epochs, lr, num_samples, patience, prob_tol, entropy_threshold, estimator, baseline_decay: Refer to reinforce.
 
     Returns: 
     bernoullis: A tensor of bernoullis variable. One variable for each attention heads. Each denote the probability of selecting this attention head.
@@ -278,57 +1076,58 @@ def avg_reinforce(mean_activations, model_helper, reinforce_data, eval_data):
 
     num_layer = model_helper.model_config["n_layers"]
     num_heads = model_helper.model_config["n_heads"]
-    lr = 0.1
     eps = 1e-3
-    epoch = 600
+    ###Placed once, every rollout hook then reads the task vector from its own layer's device
+    mean_activations = place_activations(mean_activations, model_helper.model, model_helper.model_config, split_idx=model_helper.split_idx)
 
     #(num_layer, num_head)
     bernoullis = [torch.neg(torch.ones(num_heads)).requires_grad_() for _ in range(num_layer)]
     optim = torch.optim.Adam(bernoullis, lr=lr)
+    start_epoch, val_history, baseline = 0, [], None
+    if resume and checkpoint_path is not None and os.path.exists(checkpoint_path):
+        checkpoint = load_reinforce_checkpoint(checkpoint_path, bernoullis, optim, settings_key=settings_key)
+        start_epoch, data_seed, val_history = checkpoint["epoch"], checkpoint["data_seed"], checkpoint["val_history"]
+        baseline = checkpoint["extra"].get("baseline")
+        if checkpoint["extra"].get("stop_reason") is not None:
+            print(f"avg_reinforce already stopped after {start_epoch} epochs: {checkpoint['extra']['stop_reason']}")
+            return bernoullis
+        print(f"resuming avg_reinforce from epoch {start_epoch} of {checkpoint_path}")
+
+    if data_seed is None:
+        data_seed = random.getrandbits(32)
+    epoch_inputs = Prefetcher(lambda index: prepare_avg_reinforce_input(model_helper, reinforce_data, item_rng(data_seed, index)), n_epochs,
+                              depth=prefetch_depth, num_workers=prefetch_workers, start=start_epoch)
+
     with torch.set_grad_enabled(True):
 
-        for epoch in tqdm(range(epoch)):
+        for epoch, (input_full, labels, target_len) in enumerate(tqdm(epoch_inputs, initial=start_epoch, total=n_epochs), start=start_epoch):
             
             loss_list = []
             saved_log_probs = []
 
-            text, image_list, target_out, _ = model_helper.format_func(reinforce_data, None, num_shot=0, model_helper=model_helper)
-
-            if type(target_out)==list:
-                target_out = target_out[0]
-
-
-            ###Constructing a label for taking average loss
-            if model_helper.space:
-                            target_out = " " + target_out
-            # target_token = model_helper.tokenizer(target_out, return_tensors='pt')["input_ids"][0][model_helper.nonspecial_idx].unsqueeze(dim=0).to("cuda")
-            input_full = model_helper.insert_image(text, image_list, gt=target_out)
-            labels = input_full[0].clone()
-            target_len = model_helper.tokenizer(target_out, return_tensors='pt')["input_ids"][0].shape[0]
-            labels[:, :-target_len] = -100
-
-
             sigmoid_tensor = torch.stack([torch.sigmoid(bernoulli).clamp(min=eps, max=1-eps) for bernoulli in bernoullis])
             prob_dist = torch.distributions.Bernoulli(sigmoid_tensor)
+            ###Every label that is not -100 has to be inside the replayed suffix
+            prefix_cache = build_prefix_cache(input_full, model_helper, n_suffix=target_len + 1) if use_prefix_cache else None
 
             ###Sampling the distribution many times to reduce variance. Each 
-            for _ in range(8):
+            for _ in range(num_samples):
 
                 ##Current sample
                 sampled = prob_dist.sample()
                 saved_log_probs.append(prob_dist.log_prob(sampled))
 
                 with torch.no_grad():
-                    out= reinforce_activation_replacement(input_full, mean_activations, model_helper, sampled, last_token_only=True, gt=labels, intervention_token=-target_len-1)
+                    out= reinforce_activation_replacement(input_full, mean_activations, model_helper, sampled, last_token_only=True, gt=labels, intervention_token=-target_len-1, prefix_cache=prefix_cache)
                     loss_list.append(out)
 
             policy_loss = []
-            loss_list = torch.tensor(loss_list)
-            loss_list = (loss_list - loss_list.mean())/(loss_list.std() + eps)
+            loss_list, baseline = reinforce_advantages(torch.tensor(loss_list), estimator, baseline, baseline_decay, eps)
 
             for log_prob, R in zip(saved_log_probs, loss_list):
                 policy_loss.append(log_prob * R)
 
+            prev_probs = sigmoid_tensor.detach()
             optim.zero_grad()
             policy_loss = torch.cat(policy_loss).sum()
             policy_loss.backward()
@@ -336,11 +1135,19 @@ def avg_reinforce(mean_activations, model_helper, reinforce_data, eval_data):
             torch.cuda.empty_cache()
             if epoch % 50 == 0:
                 print(policy_loss.item())
-                validate_reinforce(model_helper, bernoullis, eps, mean_activations, eval_data, epoch)
+                val_history.append((epoch, validate_reinforce(model_helper, bernoullis, eps, mean_activations, eval_data, epoch, use_prefix_cache=use_prefix_cache, eval_batch_size=eval_batch_size)))
+
+            stop_reason = reinforce_stop_reason(bernoullis, prev_probs, val_history, eps, patience=patience, prob_tol=prob_tol, entropy_threshold=entropy_threshold)
+            if checkpoint_path is not None and ((epoch + 1) % checkpoint_every == 0 or epoch + 1 == n_epochs or stop_reason is not None):
+                save_reinforce_checkpoint(checkpoint_path, bernoullis, optim, epoch + 1, data_seed, val_history, extra={"baseline": baseline, "stop_reason": stop_reason},
+                                          settings_key=settings_key)
+            if stop_reason is not None:
+                print(f"avg_reinforce stopped after {epoch + 1} of {n_epochs} epochs: {stop_reason}")
+                break
     return bernoullis
 
 
-def reinforce_activation_replacement(model_input, avg_activations, model_helper, sampled, last_token_only=True, gt=None, intervention_token=None):
+def reinforce_activation_replacement(model_input, avg_activations, model_helper, sampled, last_token_only=True, gt=None, intervention_token=None, prefix_cache=None, batched_input=False):
 
     """
     This function performs Reinforce to select the attentions that encodes ICL examples.
@@ -349,138 +1156,424 @@ def reinforce_activation_replacement(model_input, avg_activations, model_helper,
     model_input: Input to the forward function. Refer to model.py
     avg_activations:get_last_mean_head_activations
     model_helper:
-    sampeld:
+    sampeld: A (layer, head) mask, or a (batch, layer, head) stack of masks. A stack is evaluated as one batch where row i uses mask i.
     last_token_only:
+    prefix_cache: From build_prefix_cache. If given, only the last prefix_cache["n_suffix"] tokens are run, on top of the cached clean prefix.
+    batched_input: model_input is a left padded batch from insert_image_batch, and the (layer, head) mask is applied to every row.
 
     Returns: 
     output: The logit of the first output token
     """
 
-    ###This function returns a list of locations to perform intervention on based on sampled. List((layer, head, token_idx)). Token_idx is default to -1, meaning we always perform intervention on the generated token
+    batched_mask = None
+    n_repeat = 1
+    if sampled.dim() == 3:
+        batched_mask = sampled
+        n_repeat = sampled.shape[0]
+        model_input = model_helper.repeat_input(model_input, n_repeat)
+        sampled = sampled.amax(dim=0)
+
+    ###This function returns the locations to perform intervention on based on sampled. Dict(layer: heads). The intervention is always performed on the last token (or intervention_token)
     intervention_locations = reinforce_intervention_location(sampled)
 
 
     intervention_fn = last_replace_activation_w_avg(layer_head_token_pairs=intervention_locations, avg_activations=avg_activations, 
                                                 model=model_helper.model, model_config=model_helper.model_config,
-                                                batched_input=False, last_token_only=last_token_only, split_idx=model_helper.split_idx, intervention_token=intervention_token)
+                                                batched_input=batched_input, last_token_only=last_token_only, split_idx=model_helper.split_idx, intervention_token=intervention_token,
+                                                batched_mask=batched_mask)
 
     with TraceDict(model_helper.model, layers=model_helper.model_config['attn_hook_names'], edit_output=intervention_fn, retain_grad=True) as td: 
+        if prefix_cache is None:
+            result = model_helper.forward(model_input, labels=gt)
+        else:
+            result = forward_with_prefix_cache(model_input, model_helper, prefix_cache, n_repeat=n_repeat, labels=gt)
+
         if gt is None:               
-            output = model_helper.forward(model_input, labels=gt).logits[:,-1,:] # batch_size x n_tokens x vocab_size, only want last token prediction
+            output = result.logits[:,-1,:] # batch_size x n_tokens x vocab_size, only want last token prediction
         else:
-            output = model_helper.forward(model_input, labels=gt).loss
+            output = result.loss
 
     return output
 
 
+def build_prefix_cache(model_input, model_helper, n_suffix=1):
+
+    """
+    Runs the clean prompt, without any intervention, up to its last n_suffix tokens and keeps the past_key_values.
+    The intervention only touches the last tokens, so every head mask can reuse the same prefix.
+
+    Parameters:
+    model_input: Output of model_helper.insert_image
+    model_helper:
+    n_suffix: Number of trailing tokens that are left out of the prefix and replayed for every mask
+
+    Returns: 
+    prefix_cache: A dict with the past_key_values, the prefix length and n_suffix
+    """
+
+    with torch.no_grad():
+        past_key_values = model_helper.prefill(model_input, n_suffix=n_suffix)
+
+    ###Cache objects are extended in place by the suffix forward. Their length is kept so they can be cropped back.
+    prefix_len = past_key_values.get_seq_length() if hasattr(past_key_values, "get_seq_length") else None
+    return {"past_key_values": past_key_values, "prefix_len": prefix_len, "n_suffix": n_suffix}
+
+
+def expand_past_key_values(past_key_values, n):
+
+    """
+    Repeats past_key_values n times along the batch dimension, in the same order as model_helper.repeat_input.
+    Works for the legacy tuple format and for Cache objects.
+    """
+
+    is_cache = hasattr(past_key_values, "to_legacy_cache")
+    legacy = past_key_values.to_legacy_cache() if is_cache else past_key_values
+    expanded = tuple(tuple(t.repeat(n, *([1] * (t.dim() - 1))) for t in layer) for layer in legacy)
+    if is_cache:
+        return type(past_key_values).from_legacy_cache(expanded)
+    return expanded
+
+
+def forward_with_prefix_cache(model_input, model_helper, prefix_cache, n_repeat=1, labels=None):
+
+    """
+    Runs the last prefix_cache["n_suffix"] tokens of model_input on top of the cached prefix.
+    model_input may be repeated n_repeat times along the batch dimension, the prefix is then expanded to match.
+    """
+
+    n_suffix = prefix_cache["n_suffix"]
+    past_key_values = prefix_cache["past_key_values"]
+    if n_repeat > 1:
+        past_key_values = expand_past_key_values(past_key_values, n_repeat)
+
+    if labels is not None:
+        labels = labels[:, -n_suffix:]
+
+    result = model_helper.forward_suffix(model_input, past_key_values, n_suffix=n_suffix, labels=labels)
+
+    if n_repeat == 1 and hasattr(past_key_values, "crop"):
+        past_key_values.crop(prefix_cache["prefix_len"])
+
+    return result
+
+
 def reinforce_intervention_location(sampled, categorical=None, token_idx = -1):
-    intervention_locations = []
-    #(layer, head)
 
-    patch_idx = torch.nonzero(sampled)
-    count = 0
-    for _ in patch_idx:
-        cur_layer = _[0]
-        cur_head = _[1]
-        intervention_locations.append((cur_layer, cur_head, -1))
+    """
+    Compiles a sampled (layer, head) mask into the intervention locations.
+
+    Returns: 
+    intervention_locations: A dict {layer: LongTensor of selected heads}. Layers without any selected head are left out.
+    """
+
+    intervention_locations = {}
+    for layer in torch.nonzero(sampled.any(dim=-1)).flatten().tolist():
+        intervention_locations[layer] = torch.nonzero(sampled[layer]).flatten()
 
     return intervention_locations
 
 
-###Based on Function Vector: https://github.com/ericwtodd/function_vectors/blob/874d6e93c099d71fe4a2d76551fab233e60062c2/src/utils/intervention_utils.py#L16
-def last_replace_activation_w_avg(layer_head_token_pairs, avg_activations, model, model_config, batched_input=False, last_token_only=False, patching=False, replace_layer = 0, split_idx=2, intervention_token=None):
+def compile_intervention_locations(intervention_locations):
 
     """
-    This function performs intervention on during generation.
+    Converts the old list of (layer, head, token_idx) tuples into the {layer: LongTensor of heads} form. Dicts are returned as they are.
+    """
 
-    This function defaults to perform intervention during the full generation. To perform intervention on certain token/generation step, modify the function accordingly.
+    if isinstance(intervention_locations, dict):
+        return intervention_locations
+
+    heads = {}
+    for (layer, head_n, token_n) in intervention_locations:
+        heads.setdefault(int(layer), []).append(int(head_n))
+    return {layer: torch.tensor(head_list) for layer, head_list in heads.items()}
+
+
+def intervention_locations_to_mask(intervention_locations, n_layers, n_heads):
+
+    """
+    Inverse of reinforce_intervention_location. Returns the (layer, head) mask of the selected heads.
     """
 
+    mask = torch.zeros(n_layers, n_heads)
+    for layer, heads in compile_intervention_locations(intervention_locations).items():
+        mask[layer, heads.cpu()] = 1
+    return mask
 
-    if patching:
-        edit_layers = [replace_layer]
-    else:
-        edit_layers = [x[0] for x in layer_head_token_pairs]
 
+###Based on Function Vector: https://github.com/ericwtodd/function_vectors/blob/874d6e93c099d71fe4a2d76551fab233e60062c2/src/utils/intervention_utils.py#L16
+def place_activations(avg_activations, model, model_config, split_idx=2, layers=None):
 
-    def rep_act(output, layer_name, inputs):
-        current_layer = int(layer_name.split('.')[split_idx])
+    """
+    Splits the mean activations into one (head, head_dim) tensor per layer, on the device and in the dtype of that layer's projection.
+    With device_map="auto" the layers live on different GPUs. Placing the task vector once, before the rollouts, keeps the hooks from
+    copying it across devices on every forward pass.
 
-        token_len = inputs[0].shape[1]
-        if current_layer in edit_layers:
-            if isinstance(inputs, tuple):
-                inputs = inputs[0]
+    Parameters:
+    avg_activations: (layer, head, 1, head_dim) from get_last_mean_head_activations. Already placed activations are returned as they are.
+    layers: Only place these layers. All the hooked layers when None.
 
-            
-            # Determine shapes for intervention
-            original_shape = inputs.shape
-            new_shape = inputs.size()[:-1] + (model_config['n_heads'], model_config['resid_dim']//model_config['n_heads']) # split by head: + (n_attn_heads, hidden_size/n_attn_heads)
-            inputs = inputs.view(*new_shape) # inputs shape: (batch_size , tokens (n), heads, hidden_dim)
+    Returns: 
+    A dict {layer: (head, head_dim) tensor}
+    """
 
-            # Patch activations only at the last token for interventions like
+    if isinstance(avg_activations, dict):
+        return avg_activations
 
+    layer_names = {int(layer_name.split('.')[split_idx]): layer_name for layer_name in model_config['attn_hook_names']}
+    placed = {}
+    for layer in (layer_names if layers is None else layers):
+        weight = get_module(model, layer_names[layer]).weight
+        placed[layer] = avg_activations[layer, :, 0].to(weight.device, weight.dtype)
+    return placed
 
-            # cloned_inputs = inputs.clone()
 
-            if last_token_only:
+def last_replace_activation_w_avg(layer_head_token_pairs, avg_activations, model, model_config, batched_input=False, last_token_only=False, patching=False, replace_layer = 0, split_idx=2, intervention_token=None, batched_mask=None, delta_only=True):
 
-                for (layer,head_n, token_n) in layer_head_token_pairs:
+    """
+    This function performs intervention on during generation.
 
-                    if layer == current_layer:
-   
-                        #cloned_inputs[-1,-1,head_n] = avg_activations[layer,head_n,0]
-                        inputs[-1,-1,head_n] = avg_activations[layer,head_n,0]
+    This function defaults to perform intervention during the full generation. To perform intervention on certain token/generation step, modify the function accordingly.
 
-            elif intervention_token is not None:
-                for (layer,head_n, token_n) in layer_head_token_pairs:
+    layer_head_token_pairs: From reinforce_intervention_location. The old list of (layer, head, token_idx) tuples is also accepted.
+    avg_activations: From place_activations. A mean activations tensor is placed on every call, which REINFORCE avoids by placing it once.
+    batched_input: Replace the heads in every batch row instead of only the last one.
+    batched_mask: Optional (batch, layer, head) mask. When given, row i of the input only gets the heads selected in batched_mask[i] replaced.
+    delta_only: Add (avg - orig)[selected heads] @ W[:, head slice].T to the module output at the edited position, instead of recomputing the projection over every token.
+                The cost no longer depends on the sequence length, and the bias of the projection is kept as it is.
+    """
 
-                    if layer == current_layer:
-   
-                        #cloned_inputs[-1,intervention_token,head_n] = avg_activations[layer,head_n,0]
-                        inputs[-1,intervention_token,head_n] = avg_activations[layer,head_n,0]
+    head_index = compile_intervention_locations(layer_head_token_pairs)
+    if patching:
+        head_index = {layer: heads for layer, heads in head_index.items() if layer == replace_layer}
+
+    ###Everything the hook needs is built once here, so layers without intervention return after a single dict lookup
+    hook_layers = {layer_name: int(layer_name.split('.')[split_idx]) for layer_name in model_config['attn_hook_names']}
+    layer_names = {layer: layer_name for layer_name, layer in hook_layers.items()}
+    proj_modules = {layer: get_module(model, layer_names[layer]) for layer in head_index}
+
+    ###Every edited layer reads its replacement on the device and in the dtype of its own projection. With device_map="auto" the layers
+    ###live on different GPUs, and the hook then never copies anything between devices. The per rollout masks move once per device.
+    placed = place_activations(avg_activations, model, model_config, split_idx=split_idx, layers=head_index)
+    layer_devices = {layer: proj_modules[layer].weight.device for layer in head_index}
+    devices = set(layer_devices.values())
+    if batched_mask is not None:
+        device_masks = {device: batched_mask.bool().to(device) for device in devices}
+        #(batch, head) mask and (head, head_dim) replacement per edited layer
+        row_masks = {layer: device_masks[layer_devices[layer]][:, layer].unsqueeze(dim=-1) for layer in head_index}
+        replacements = {layer: placed[layer].unsqueeze(dim=0) for layer in head_index}
+    else:
+        head_index = dict(head_index)
+        for device in devices:
+            device_layers = [layer for layer in head_index if layer_devices[layer] == device]
+            device_heads = torch.cat([head_index[layer] for layer in device_layers]).to(device)
+            head_index.update(zip(device_layers, device_heads.split([len(head_index[layer]) for layer in device_layers])))
+        #(n_selected_heads, head_dim) replacement per edited layer
+        replacements = {layer: placed[layer][heads] for layer, heads in head_index.items()}
+
+    if last_token_only:
+        token_n = -1
+    else:
+        token_n = intervention_token
 
-            #cloned_inputs = cloned_inputs.view(*original_shape)
-            inputs = inputs.view(*original_shape)
 
-            proj_module = get_module(model, layer_name)
+    def rep_act(output, layer_name, inputs):
+        current_layer = hook_layers[layer_name]
 
-            out_proj = proj_module.weight
+        if current_layer not in replacements:
+            return output
 
-            #new_output = torch.matmul(cloned_inputs, out_proj.T)
-            new_output = torch.matmul(inputs, out_proj.T)
+        if isinstance(inputs, tuple):
+            inputs = inputs[0]
 
-            return new_output
-        else:
+        
+        # Determine shapes for intervention
+        original_shape = inputs.shape
+        new_shape = inputs.size()[:-1] + (model_config['n_heads'], model_config['resid_dim']//model_config['n_heads']) # split by head: + (n_attn_heads, hidden_size/n_attn_heads)
+        inputs = inputs.view(*new_shape) # inputs shape: (batch_size , tokens (n), heads, hidden_dim)
+
+        proj_module = proj_modules[current_layer]
+
+        out_proj = proj_module.weight
+
+        if delta_only:
+            if token_n is None:
+                return output
+            replacement = replacements[current_layer]
+            rows = slice(None) if (batched_input or batched_mask is not None) else slice(-1, None)
+            #(rows, heads, hidden_dim)
+            orig = inputs[rows, token_n]
+
+            if batched_mask is not None:
+                delta = torch.where(row_masks[current_layer], replacement - orig, torch.zeros_like(orig))
+                weight = out_proj
+            else:
+                heads = head_index[current_layer]
+                delta = replacement - orig[:, heads]
+                #Columns of the projection that read the selected heads: (out_dim, n_selected_heads * hidden_dim)
+                weight = out_proj.view(out_proj.shape[0], model_config['n_heads'], -1)[:, heads].reshape(out_proj.shape[0], -1)
+
+            output[rows, token_n] += torch.matmul(delta.reshape(delta.shape[0], -1), weight.T)
             return output
+
+        # Patch activations only at the last token for interventions like
+        if token_n is not None:
+            replacement = replacements[current_layer]
+
+            if batched_mask is not None:
+                inputs[:, token_n] = torch.where(row_masks[current_layer], replacement, inputs[:, token_n])
+            elif batched_input:
+                inputs[:, token_n, head_index[current_layer]] = replacement
+            else:
+                inputs[-1, token_n, head_index[current_layer]] = replacement
+
+        inputs = inputs.view(*original_shape)
+
+        new_output = torch.matmul(inputs, out_proj.T)
+        if proj_module.bias is not None:
+            new_output = new_output + proj_module.bias
+
+        return new_output
     return rep_act
 
 
-def fv_intervention_natural_text(model_input, model_helper, max_new_tokens=10, return_item="both", intervention_locations=None, avg_activations=None):
+def fv_intervention_natural_text(model_input, model_helper, max_new_tokens=10, return_item="both", intervention_locations=None, avg_activations=None, batched_input=False, paired=False):
 
     """
     This function is a wrapper of generation intervention
+
+    batched_input: model_input is a left padded batch from insert_image_batch. The heads are replaced at the current last position of every row,
+                   and both outputs are lists with one text per row.
+    paired: With return_item="both", generate the clean and the intervened outputs in a single call. Refer to paired_intervention_generate.
     """
 
+    if paired and return_item == "both":
+        return paired_intervention_generate(model_input, model_helper, max_new_tokens, intervention_locations, avg_activations, batched_input=batched_input)
+
+    generate = model_helper.generate_batch if batched_input else model_helper.generate
+
     #Text form to avoid for-loop inside eval loop
     clean_output, intervention_output = "None", "None"
 
     if return_item == "clean" or return_item == "both":
     
-        clean_output = model_helper.generate(model_input, max_new_tokens)
+        clean_output = generate(model_input, max_new_tokens)
 
 
     if return_item == "interv" or return_item == "both":
         
         intervention_fn = last_replace_activation_w_avg(layer_head_token_pairs=intervention_locations, avg_activations=avg_activations, 
                                                     model=model_helper.model, model_config=model_helper.model_config,
-                                                    batched_input=False, last_token_only=True, split_idx=model_helper.split_idx)
+                                                    batched_input=batched_input, last_token_only=True, split_idx=model_helper.split_idx)
             
         with TraceDict(model_helper.model, layers=model_helper.model_config['attn_hook_names'], edit_output=intervention_fn):     
-                intervention_output = model_helper.generate(model_input, max_new_tokens)
+                intervention_output = generate(model_input, max_new_tokens)
+
+    if batched_input:
+        n_rows = len(clean_output) if isinstance(clean_output, list) else len(intervention_output)
+        clean_output = clean_output if isinstance(clean_output, list) else ["None"] * n_rows
+        intervention_output = intervention_output if isinstance(intervention_output, list) else ["None"] * n_rows
 
     return clean_output, intervention_output
 
 
+def paired_intervention_generate(model_input, model_helper, max_new_tokens, intervention_locations, avg_activations, batched_input=False):
+
+    """
+    Generates the clean and the intervened outputs of model_input in one batch. The input is repeated twice along the batch dimension,
+    and a per-row mask leaves the first copy untouched and replaces the selected heads in the second copy.
+
+    Returns: 
+    clean_output, intervention_output: Texts, or lists of texts with batched_input
+    """
+
+    n_rows = input_batch_size(model_input)
+    paired_input = model_helper.repeat_input(model_input, 2)
+
+    intervention_fn = last_replace_activation_w_avg(layer_head_token_pairs=intervention_locations, avg_activations=avg_activations, 
+                                                model=model_helper.model, model_config=model_helper.model_config,
+                                                last_token_only=True, split_idx=model_helper.split_idx,
+                                                batched_mask=paired_batched_mask(intervention_locations, model_helper, n_rows))
+
+    with TraceDict(model_helper.model, layers=model_helper.model_config['attn_hook_names'], edit_output=intervention_fn):     
+        outputs = model_helper.generate_batch(paired_input, max_new_tokens)
+
+    if batched_input:
+        return outputs[:n_rows], outputs[n_rows:]
+    return outputs[0], outputs[1]
+
+
+def paired_batched_mask(intervention_locations, model_helper, n_rows):
+
+    """
+    Per-row mask of an input repeated twice with repeat_input: (2 * n_rows, layer, head), all zero for the first (clean) copy.
+    """
+
+    mask = intervention_locations_to_mask(intervention_locations, model_helper.model_config["n_layers"], model_helper.model_config["n_heads"])
+    return torch.cat([torch.zeros_like(mask).expand(n_rows, -1, -1), mask.expand(n_rows, -1, -1)])
+
+
+def option_token_ids(model_helper, options):
+
+    """
+    First answer token of every option, built the same way as the target token of reinforce.
+    """
+
+    return first_answer_tokens(model_helper, options).tolist()
+
+
+def score_options(model_input, model_helper, option_ids, return_item="both", intervention_locations=None, avg_activations=None, batched_input=False, paired=False):
+
+    """
+    Scores a closed answer set with one forward pass instead of generating. The next token logits of the option tokens are compared,
+    which gives the same decision as greedy decoding whenever the model answers with one of the options.
+
+    Parameters:
+    model_input: Output of insert_image, or of insert_image_batch with batched_input
+    model_helper:
+    option_ids: From option_token_ids
+    return_item, intervention_locations, avg_activations, batched_input, paired: Refer to fv_intervention_natural_text
+
+    Returns: 
+    clean_scores, intervention_scores: (rows, n_options) probabilities of the options, normalized over the options. None for the one that is not requested.
+    """
+
+    clean_logits, intervention_logits = None, None
+    with torch.no_grad():
+        if paired and return_item == "both":
+            n_rows = input_batch_size(model_input)
+            intervention_fn = last_replace_activation_w_avg(layer_head_token_pairs=intervention_locations, avg_activations=avg_activations, 
+                                                        model=model_helper.model, model_config=model_helper.model_config,
+                                                        last_token_only=True, split_idx=model_helper.split_idx,
+                                                        batched_mask=paired_batched_mask(intervention_locations, model_helper, n_rows))
+            with TraceDict(model_helper.model, layers=model_helper.model_config['attn_hook_names'], edit_output=intervention_fn):
+                logits = model_helper.forward(model_helper.repeat_input(model_input, 2)).logits[:, -1]
+            clean_logits, intervention_logits = logits[:n_rows], logits[n_rows:]
+        else:
+            if return_item == "clean" or return_item == "both":
+                clean_logits = model_helper.forward(model_input).logits[:, -1]
+
+            if return_item == "interv" or return_item == "both":
+                intervention_fn = last_replace_activation_w_avg(layer_head_token_pairs=intervention_locations, avg_activations=avg_activations, 
+                                                            model=model_helper.model, model_config=model_helper.model_config,
+                                                            batched_input=batched_input, last_token_only=True, split_idx=model_helper.split_idx)
+                with TraceDict(model_helper.model, layers=model_helper.model_config['attn_hook_names'], edit_output=intervention_fn):
+                    intervention_logits = model_helper.forward(model_input).logits[:, -1]
+
+    scores = [None if logits is None else torch.softmax(logits[:, option_ids].float(), dim=-1).cpu() for logits in (clean_logits, intervention_logits)]
+    return scores[0], scores[1]
+
+
+def input_batch_size(model_input):
+
+    """
+    Number of rows of the output of insert_image or insert_image_batch.
+    """
+
+    if isinstance(model_input, tuple):
+        return model_input[0].shape[0]
+    return model_input["input_ids"].shape[0]
+
+
 def eval_vqa(cur_dataset, results_path, answers):
     ds_collections = {
         'vizwiz_val': {
@@ -1,17 +1,131 @@
 #### 
+import hashlib
 import json
+import os
 import random
+from collections.abc import Sequence
+
+import numpy as np
 
 vizwiz_prompt = """First carefully understand the given examples. 
 Then use the given image and answer the question in the same way as the examples. 
 If the question can not be answered, respond unanswerable. """
 ####
 
-def open_data(dataset_name, path):
+class VQARecord:
+
+    """
+    One parsed vizwiz/okvqa line. Fields can also be read as record["image"], like the dict from json.loads.
+    """
+
+    __slots__ = ("image", "question", "answer", "question_id")
+
+    def __init__(self, image, question, answer, question_id):
+        self.image = image
+        self.question = question
+        self.answer = answer
+        self.question_id = question_id
+
+    def __getitem__(self, key):
+        return getattr(self, key)
+
+
+class VQADataset(Sequence):
+
+    """
+    A jsonl VQA dataset parsed once into parallel columns of image, question, answer and question_id.
+
+    Indexing returns a VQARecord in O(1), slicing returns a VQADataset, and random.sample works on it directly, so the format functions
+    sample few-shot examples by index without parsing any json. It can be saved to and loaded from an .npz file.
+    """
+
+    def __init__(self, image, question, answer, question_id):
+        self.image = image
+        self.question = question
+        self.answer = answer
+        self.question_id = question_id
+
+    @classmethod
+    def from_jsonl(cls, lines):
+        rows = [json.loads(line) for line in lines if line.strip()]
+        return cls([row["image"] for row in rows], [row["question"] for row in rows], [row["answer"] for row in rows], [row["question_id"] for row in rows])
+
+    def __len__(self):
+        return len(self.image)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return VQADataset(self.image[index], self.question[index], self.answer[index], self.question_id[index])
+        return VQARecord(self.image[index], self.question[index], self.answer[index], self.question_id[index])
+
+    def save(self, path, source=""):
+
+        ###Answers can be lists and question ids ints or strings, so those two columns are stored json encoded
+        np.savez(path, image=np.array(self.image), question=np.array(self.question),
+                 answer=np.array([json.dumps(answer) for answer in self.answer]),
+                 question_id=np.array([json.dumps(question_id) for question_id in self.question_id]),
+                 source=np.array(source))
+
+    @staticmethod
+    def saved_source(path):
+
+        """
+        The source stamp a cache file was saved with, "" for files saved without one.
+        """
+
+        with np.load(path) as arrays:
+            return str(arrays["source"]) if "source" in arrays.files else ""
+
+    @classmethod
+    def load(cls, path):
+        arrays = np.load(path)
+        return cls(arrays["image"].tolist(), arrays["question"].tolist(),
+                   [json.loads(answer) for answer in arrays["answer"].tolist()],
+                   [json.loads(question_id) for question_id in arrays["question_id"].tolist()])
+
+
+def source_stamp(path):
+
+    """
+    Absolute path, size and modification time of a data file. A parsed cache is only used for the file it was built from.
+    """
+
+    stat = os.stat(path)
+    return json.dumps({"path": os.path.abspath(path), "size": stat.st_size, "mtime": stat.st_mtime})
+
+
+def data_cache_path(cache_dir, path):
+
+    """
+    Parsed cache file of path inside cache_dir. Named after the absolute path, so data files with the same name (train.json) do not collide.
+    """
+
+    path_hash = hashlib.sha1(os.path.abspath(path).encode()).hexdigest()[:16]
+    return os.path.join(cache_dir, f"{os.path.basename(path)}.{path_hash}.npz")
+
+
+def open_data(dataset_name, path, parsed=False, cache_path=None):
+
+    """
+    parsed: For vizwiz/okvqa, return a VQADataset instead of the raw jsonl lines
+    cache_path: Only used with parsed. The parsed dataset is saved to this .npz file, with the source_stamp of path, and loaded from it
+                while the stamp still matches. Refer to data_cache_path.
+    """
 
     jsonl_format_dataset = ["vizwiz", "okvqa"]
     list_format_dataset = ["flower", "cub", "dtd"]
 
+    if parsed and dataset_name in jsonl_format_dataset:
+        stamp = source_stamp(path)
+        if cache_path is not None and os.path.exists(cache_path) and VQADataset.saved_source(cache_path) == stamp:
+            return VQADataset.load(cache_path)
+
+        with open(path, 'r') as json_file:
+            dataset = VQADataset.from_jsonl(json_file)
+        if cache_path is not None:
+            dataset.save(cache_path, source=stamp)
+        return dataset
+
     with open(path, 'r') as json_file:
         if dataset_name in jsonl_format_dataset:
             dataset = list(json_file)
@@ -20,7 +134,19 @@ def open_data(dataset_name, path):
     return dataset
 
 
+def parse_vqa_item(item):
+
+    """
+    Raw jsonl lines are parsed, VQARecords from a VQADataset are used as they are.
+    """
+
+    if isinstance(item, str):
+        return json.loads(item)
+    return item
+
+
 ### Each format function should return (full_text, image_list, answer, question_id)
+### rng: Optional random.Random used for every random choice, so that items can be prepared out of order and stay reproducible
 def get_format_func(cur_dataset):
 
     if cur_dataset == "vizwiz":
@@ -35,25 +161,44 @@ def get_format_func(cur_dataset):
         return format_dtd
 
 
+##Datasets whose answer is one of a closed set of options. Their answers can be scored from the logits of the option tokens instead of generated.
+answer_options = {"flower": ["A", "B"], "cub": ["A", "B"], "dtd": ["A", "B"]}
+
+
+def get_answer_options(cur_dataset):
+
+    return answer_options.get(cur_dataset)
+
+
+##The eval keeps the answer up to the first of these strings, so generation can stop there
+answer_stop_strings = {"vizwiz": [".", "\n"], "okvqa": [".", "\n"], "flower": [".", "\n"], "cub": [".", "\n"], "dtd": [".", "\n"]}
+
+
+def get_answer_stop_strings(cur_dataset):
+
+    return answer_stop_strings.get(cur_dataset)
+
+
 ####All return format will be in the form (Text, list of images, Answer, Question_id)
-def format_vizwiz(all_data, cur_item=None, num_shot=0, model_helper=None, split="train"):
+def format_vizwiz(all_data, cur_item=None, num_shot=0, model_helper=None, split="train", rng=None):
     prompt = '<image>{} Answer:'
+    rng = random if rng is None else rng
 
     image_list = []
 
     if cur_item is None:
-        data = json.loads(random.sample(all_data, 1)[0])
+        data = parse_vqa_item(rng.sample(all_data, 1)[0])
     else:
-        data = json.loads(cur_item)
+        data = parse_vqa_item(cur_item)
 
     image, question, answer, question_id = data['image'], data['question'], data['answer'], data['question_id']
 
     few_shot_prompt = ''
     if num_shot > 0:
 
-        sampled_data = random.sample(all_data, num_shot)
+        sampled_data = rng.sample(all_data, num_shot)
         for sample in sampled_data:
-            sample = json.loads(sample.strip())
+            sample = parse_vqa_item(sample)
             few_shot_prompt += prompt.format(sample['question']) + f" {sample['answer']}"
             image_list.append("../" + sample["image"])
 
@@ -64,23 +209,24 @@ def format_vizwiz(all_data, cur_item=None, num_shot=0, model_helper=None, split=
     return full_text, image_list, answer, question_id
 
 
-def format_okvqa(all_data, cur_item=None, num_shot=0, model_helper=None, split="train"):
+def format_okvqa(all_data, cur_item=None, num_shot=0, model_helper=None, split="train", rng=None):
     prompt = '<image>{} Answer:'
+    rng = random if rng is None else rng
 
     image_list = []
 
     if cur_item is None:
-        data = json.loads(random.sample(all_data, 1)[0])
+        data = parse_vqa_item(rng.sample(all_data, 1)[0])
     else:
-        data = json.loads(cur_item)
+        data = parse_vqa_item(cur_item)
 
     image, question, answer, question_id = data['image'], data['question'], data['answer'], data['question_id']
 
     few_shot_prompt = ''
     if num_shot > 0:
-        sampled_data = random.sample(all_data, num_shot)
+        sampled_data = rng.sample(all_data, num_shot)
         for sample in sampled_data:
-            sample = json.loads(sample.strip())
+            sample = parse_vqa_item(sample)
             few_shot_prompt += prompt.format(sample['question']) + f"{sample['answer']}"
             image_list.append(sample["image"])
 
@@ -91,82 +237,50 @@ def format_okvqa(all_data, cur_item=None, num_shot=0, model_helper=None, split="
     return full_text, image_list, answer, question_id
 
 
-def format_flower(all_data, cur_item=None, num_shot=0, model_helper=None, split="train"):
-
-    if cur_item is None:
-        cur_item = random.sample(all_data, 1)[0]
-
-    pos = cur_item["pos"]
-    neg = cur_item["neg"]
-    pos_label = cur_item["pos_label"]
-    neg_label = cur_item["neg_label"]
-    query = cur_item["query"]
-    rand_num = random.randint(0,1)
-    if rand_num == 0:
-        pos_example = f"<image>What is the type of flower in the image? A.{pos_label} B.{neg_label}\nAnswer with the option's letter from the given choice directly. Answer: A\n"
-        neg_example = f"<image>What is the type of flower in the image? A.{pos_label} B.{neg_label}\nAnswer with the option's letter from the given choice directly. Answer: B\n"
-        cur_query = f"<image>What is the type of flower in the image? A.{pos_label} B.{neg_label}\nAnswer with the option's letter from the given choice directly. Answer:"
-        query_label = "A"
+##Template of the binary choice datasets. The two examples and the query of a prompt share the same choices, so they only differ in the answer.
+choice_template = "<image>What is the type of {} in the image? A.{} B.{}\nAnswer with the option's letter from the given choice directly. Answer:"
 
-        return pos_example + neg_example + cur_query, [pos, neg, query], query_label, -1
-    else:
-        pos_example = f"<image>What is the type of flower in the image? A.{neg_label} B.{pos_label}\nAnswer with the option's letter from the given choice directly. Answer: B\n"
-        neg_example = f"<image>What is the type of flower in the image? A.{neg_label} B.{pos_label}\nAnswer with the option's letter from the given choice directly. Answer: A\n"
-        cur_query = f"<image>What is the type of flower in the image? A.{neg_label} B.{pos_label}\nAnswer with the option's letter from the given choice directly. Answer:"
-        query_label = "B"
 
-        return neg_example + pos_example + cur_query, [neg, pos, query], query_label, -1
+def format_choice(all_data, cur_item, subject, rng):
 
+    """
+    Builds the two-shot prompt of flower, cub and dtd. The positive and negative examples are shown first, in the same order as their labels
+    in the choices, and the query has the positive label as answer.
 
-def format_cub(all_data, cur_item=None, num_shot=0, model_helper=None, split="train"):
+    Returns:
+    The prompt, the list of images, the letter of the positive label, and -1 as question id
+    """
 
     if cur_item is None:
-        cur_item = random.sample(all_data, 1)[0]
+        cur_item = rng.sample(all_data, 1)[0]
 
     pos = cur_item["pos"]
     neg = cur_item["neg"]
     pos_label = cur_item["pos_label"]
     neg_label = cur_item["neg_label"]
     query = cur_item["query"]
-    rand_num = random.randint(0,1)
+    rand_num = rng.randint(0,1)
     if rand_num == 0:
-        pos_example = f"<image>What is the type of bird in the image? A.{pos_label} B.{neg_label}\nAnswer with the option's letter from the given choice directly. Answer: A\n"
-        neg_example = f"<image>What is the type of bird in the image? A.{pos_label} B.{neg_label}\nAnswer with the option's letter from the given choice directly. Answer: B\n"
-        cur_query = f"<image>What is the type of bird in the image? A.{pos_label} B.{neg_label}\nAnswer with the option's letter from the given choice directly. Answer:"
-        query_label = "A"
-
-        return pos_example + neg_example + cur_query, [pos, neg, query], query_label, -1
+        question = choice_template.format(subject, pos_label, neg_label)
+        return question + " A\n" + question + " B\n" + question, [pos, neg, query], "A", -1
     else:
-        pos_example = f"<image>What is the type of bird in the image? A.{neg_label} B.{pos_label}\nAnswer with the option's letter from the given choice directly. Answer: B\n"
-        neg_example = f"<image>What is the type of bird in the image? A.{neg_label} B.{pos_label}\nAnswer with the option's letter from the given choice directly. Answer: A\n"
-        cur_query = f"<image>What is the type of bird in the image? A.{neg_label} B.{pos_label}\nAnswer with the option's letter from the given choice directly. Answer:"
-        query_label = "B"
+        question = choice_template.format(subject, neg_label, pos_label)
+        return question + " A\n" + question + " B\n" + question, [neg, pos, query], "B", -1
 
-        return neg_example + pos_example + cur_query, [neg, pos, query], query_label, -1
-    
 
-def format_dtd(all_data, cur_item=None, num_shot=0, model_helper=None, split="train"):
+def format_flower(all_data, cur_item=None, num_shot=0, model_helper=None, split="train", rng=None):
 
-    if cur_item is None:
-        cur_item = random.sample(all_data, 1)[0]
+    rng = random if rng is None else rng
+    return format_choice(all_data, cur_item, "flower", rng)
 
-    pos = cur_item["pos"]
-    neg = cur_item["neg"]
-    pos_label = cur_item["pos_label"]
-    neg_label = cur_item["neg_label"]
-    query = cur_item["query"]
-    rand_num = random.randint(0,1)
-    if rand_num == 0:
-        pos_example = f"<image>What is the type of texture in the image? A.{pos_label} B.{neg_label}\nAnswer with the option's letter from the given choice directly. Answer: A\n"
-        neg_example = f"<image>What is the type of texture in the image? A.{pos_label} B.{neg_label}\nAnswer with the option's letter from the given choice directly. Answer: B\n"
-        cur_query = f"<image>What is the type of texture in the image? A.{pos_label} B.{neg_label}\nAnswer with the option's letter from the given choice directly. Answer:"
-        query_label = "A"
 
-        return pos_example + neg_example + cur_query, [pos, neg, query], query_label, -1
-    else:
-        pos_example = f"<image>What is the type of texture in the image? A.{neg_label} B.{pos_label}\nAnswer with the option's letter from the given choice directly. Answer: B\n"
-        neg_example = f"<image>What is the type of texture in the image? A.{neg_label} B.{pos_label}\nAnswer with the option's letter from the given choice directly. Answer: A\n"
-        cur_query = f"<image>What is the type of texture in the image? A.{neg_label} B.{pos_label}\nAnswer with the option's letter from the given choice directly. Answer:"
-        query_label = "B"
+def format_cub(all_data, cur_item=None, num_shot=0, model_helper=None, split="train", rng=None):
+
+    rng = random if rng is None else rng
+    return format_choice(all_data, cur_item, "bird", rng)
+    
+
+def format_dtd(all_data, cur_item=None, num_shot=0, model_helper=None, split="train", rng=None):
 
-        return neg_example + pos_example + cur_query, [neg, pos, query], query_label, -1
\ No newline at end of file
+    rng = random if rng is None else rng
+    return format_choice(all_data, cur_item, "texture", rng)